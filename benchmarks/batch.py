@@ -0,0 +1,91 @@
+"""
+Rank a fleet of queries against a local stub of Bing Maps and polttoaine.net,
+once one query at a time with a calculator of its own, as separate runs of the
+CLI would, and once as a batch sharing routes and the route cache. Both start
+from an empty data folder. Reports queries per second and requests made.
+
+    python -m benchmarks.batch --latency 0.05 --queries 20
+"""
+import contextlib
+import io
+import json
+import time
+
+import click
+
+from benchmarks.stub import stubbed
+
+
+ORIGINS = ["Helsinki", "Lahti", "Espoo", "Vantaa", "Kerava"]
+
+CONSUMPTIONS = [5.5, 7.2, 9.0]
+
+
+def fleet(count):
+    """ Queries of vehicles with different origins, consumptions and fuels """
+    from src.batch import normalize_query
+    from src.providers import FUELS
+
+    return [normalize_query({
+        "from": ORIGINS[i % len(ORIGINS)],
+        "to": ORIGINS[(i + 1) % len(ORIGINS)] if i % 4 == 3 else None,
+        "consumption": CONSUMPTIONS[i % len(CONSUMPTIONS)],
+        "fuel": FUELS[i % len(FUELS)],
+    }) for i in range(count)]
+
+
+def sequential(queries, stations, index):
+    from src.calc import PriceCalculator
+
+    for query in queries:
+        location = (query["from"], query["to"]) if query["to"] else query["from"]
+        PriceCalculator(
+            location, query["amount"], query["consumption"], query["distance"],
+            query["age"], query["fuel"]
+        ).calculate_prices(stations, index, query["limit"])
+
+
+def batch(queries, stations, index):
+    from src.batch import BatchRanker
+
+    BatchRanker(stations, index).rank(queries)
+
+
+def _run(stub, function, *args):
+    stub.clear_data()
+    before = stub.counts()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        function(*args)
+    wall = time.perf_counter() - start
+    return {
+        "wall_s": wall,
+        "queries_per_second": len(args[0]) / wall,
+        "requests": stub.requests_since(before),
+    }
+
+
+@click.command()
+@click.option('--latency', default=0.02, help='Seconds stub waits before answering')
+@click.option('--queries', default=20, help='Queries in the fleet')
+def main(latency, queries):
+    """ Compare batch ranking against ranking queries one by one """
+    with stubbed(latency) as stub:
+        # Imported late, settings are read from the environment pointing to the stub
+        from src.providers import configured_provider
+
+        provider = configured_provider()
+        stations = provider.fetch_stations()
+        fleet_queries = fleet(queries)
+        results = {
+            "queries": queries,
+            "latency_s": latency,
+            "sequential": _run(stub, sequential, fleet_queries, stations,
+                               provider.index),
+            "batch": _run(stub, batch, fleet_queries, stations, provider.index),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""
+Measure accuracy against routing calls of route mode detour pruning. Routes
+come from the local router over the bundled sample road graph, standing in for
+recorded routes, so detours follow streets rather than straight lines, and
+stations are synthetic, spread over the area of the graph. Each trip is ranked
+exhaustively and then with a limit for each number of detour
+candidates routed per ranked station, 0 meaning as many as an exact ranking
+needs. Calls are counted as routed pairs, one request each without the
+distance matrix, and as distance matrix requests with it, where stations are
+routed in larger batches.
+
+    python -m benchmarks.detour --limit 10
+"""
+import contextlib
+import io
+import json
+import os
+import tempfile
+from datetime import datetime
+
+import click
+import numpy as np
+import pandas as pd
+
+from benchmarks.routing import GRIDS, HIGHWAY, SAMPLE_GRAPH
+from benchmarks.stub import load_fixture
+
+
+TRIPS = [
+    ("Helsinki", "Lahti"),
+    ("Espoo", "Kerava"),
+    ("Vantaa", "Espoo"),
+    ("Kerava", "Helsinki"),
+]
+
+CANDIDATES = [1, 2, 3, 5, 0]
+
+CORRIDOR = 1.5  # Km
+
+STATIONS = 3000
+
+HIGHWAY_STATIONS = 200
+
+
+def synthetic_stations(rng):
+    """ Stations over the Helsinki grid of the sample graph and its highway """
+    south, west, north, east, _, _ = GRIDS[0]
+    lat = np.concatenate([rng.uniform(south, north, STATIONS),
+                          rng.uniform(HIGHWAY[0][0], HIGHWAY[-1][0], HIGHWAY_STATIONS)])
+    lon = np.concatenate([
+        rng.uniform(west, east, STATIONS),
+        np.interp(lat[STATIONS:], *zip(*HIGHWAY)) + rng.normal(0, 0.01, HIGHWAY_STATIONS)
+    ])
+    count = len(lat)
+    return pd.DataFrame({
+        "Name": [f'Station {i}' for i in range(count)],
+        "95E10 Price": np.round(rng.uniform(1.55, 1.85, count), 3),
+        "Timestamp": [datetime.now()] * count,
+        "lat": lat,
+        "lon": lon,
+    }, index=[str(i) for i in range(count)])
+
+
+def counting_router(graph, matrix):
+    """ Local router counting routed pairs, or distance matrix requests """
+    from src.graph import LocalRouter
+    from src.route import _group_for_matrix
+
+    class CountingRouter(LocalRouter):
+        calls = 0
+
+        def get_distances(self, pairs, cache):
+            unique = list(dict.fromkeys(pairs))
+            self.calls += len(list(_group_for_matrix(unique))) if self.matrix \
+                else len(unique)
+            return super().get_distances(pairs, cache)
+
+    router = CountingRouter(graph)
+    router.matrix = matrix
+    return router
+
+
+def rank(stations, index, trip, graph, matrix, limit=None, candidates=0):
+    from src.calc import PriceCalculator
+
+    router = counting_router(graph, matrix)
+    with contextlib.redirect_stdout(io.StringIO()):
+        calculator = PriceCalculator(trip, 40, 7.2, CORRIDOR, 5, router=router)
+        calculator.detour_candidates = candidates
+        _, ranked = calculator.calculate_prices(stations, index, limit)
+    return ranked, router
+
+
+def accuracy(exact, ranked, limit):
+    """ Share of the exact top stations found and worst total price error """
+    top = exact.head(limit)
+    found = ranked.head(limit)
+    if top.empty:
+        return 1.0, 0.0
+    error = np.abs(found["Total price"].to_numpy() -
+                   top["Total price"].to_numpy()[:len(found)])
+    return (len(set(top.index) & set(found.index)) / len(top),
+            float(error.max()) if len(error) else None)
+
+
+@click.command()
+@click.option('--limit', default=10, help='Stations ranked per trip')
+def main(limit):
+    """ Benchmark detour candidates against accuracy """
+    os.environ["DATA_FOLDER"] = tempfile.mkdtemp(prefix='gasoline-benchmark-')
+    # Imported late, settings are read from the environment
+    from src.graph import RoadGraph
+    from src.spatial import StationIndex
+
+    places = {name: f'{lat},{lon}'
+              for name, (lat, lon) in json.loads(load_fixture('places.json')).items()}
+    stations = synthetic_stations(np.random.default_rng(0))
+    index = StationIndex.from_stations(stations)
+    graph = RoadGraph.load(SAMPLE_GRAPH)
+    results = {"limit": limit, "trips": {}}
+    for start, end in TRIPS:
+        trip = places[start], places[end]
+        exact, pairs = rank(stations, index, trip, graph, False)
+        _, requests = rank(stations, index, trip, graph, True)
+        runs = {"exhaustive": {"stations": len(exact), "pairs": pairs.calls,
+                               "requests": requests.calls}}
+        for candidates in CANDIDATES:
+            ranked, pairs = rank(stations, index, trip, graph, False, limit, candidates)
+            _, requests = rank(stations, index, trip, graph, True, limit, candidates)
+            found, error = accuracy(exact, ranked, limit)
+            runs[f"candidates={candidates}"] = {
+                "pairs": pairs.calls, "requests": requests.calls,
+                "top_found": found, "max_price_error": error,
+            }
+        results["trips"][f'{start} -> {end}'] = runs
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Time merging stations of two providers listing many of the same sites, and
+check that equally named stations near each other are merged into the
+freshest one while a differently named station nearby is kept.
+
+    python -m benchmarks.merge
+"""
+import json
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from src.providers import merge_stations
+
+
+STATIONS = 5000
+
+SHARED = 0.5  # Share of stations listed by both providers
+
+REPEAT = 5
+
+
+def synthetic_sources(rng, count=STATIONS):
+    """
+    Two providers with count stations on a grid far wider than the duplicate
+    distances, the second listing SHARED of them a few metres off and fresher
+    """
+    now = datetime.now()
+    side = int(np.ceil(np.sqrt(count)))
+    cells = np.arange(count)
+    first = pd.DataFrame({
+        "Name": [f'Station {i}' for i in cells],
+        "95E10 Price": np.round(1.4 + rng.random(count) * 0.4, 3),
+        "Timestamp": [now - timedelta(days=1)] * count,
+        "lat": 60 + (cells // side) * 0.02,
+        "lon": 24 + (cells % side) * 0.04,
+    }, index=[str(i) for i in cells])
+    shared = rng.choice(count, int(count * SHARED), replace=False)
+    second = first.iloc[shared].assign(
+        Timestamp=now,
+        lat=lambda stations: stations["lat"] + rng.normal(0, 0.0001, len(shared)),
+        lon=lambda stations: stations["lon"] + rng.normal(0, 0.0002, len(shared)),
+    )
+    second.index = [f'b{id}' for id in second.index]
+    expected = {f'a:{id}' for id in first.index.difference(first.index[shared])}
+    expected |= {f'b:{id}' for id in second.index}
+    return [("a", first), ("b", second)], expected
+
+
+def same_site_case():
+    """
+    Same station listed by two providers about 110 metres apart, beyond
+    DUPLICATE_DISTANCE, under the same name, and another station 70 metres away
+    """
+    now = datetime.now()
+    first = pd.DataFrame({
+        "Name": ["Neste Kamppi", "ABC Kamppi"],
+        "95E10 Price": [1.599, 1.579],
+        "Timestamp": [now - timedelta(hours=5), now - timedelta(hours=5)],
+        "lat": [60.1690, 60.1695],
+        "lon": [24.9320, 24.9330],
+    }, index=["1", "2"])
+    second = pd.DataFrame({
+        "Name": ["neste  KAMPPI"],
+        "95E10 Price": [1.589],
+        "Timestamp": [now],
+        "lat": [60.1692],
+        "lon": [24.9340],
+    }, index=["7"])
+    return [("a", first), ("b", second)], {"a:2", "b:7"}
+
+
+def main():
+    sources, expected = synthetic_sources(np.random.default_rng(0))
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        merged = merge_stations(sources)
+    merge_s = (time.perf_counter() - start) / REPEAT
+    case, case_expected = same_site_case()
+    print(json.dumps({
+        "stations": sum(len(stations) for _, stations in sources),
+        "merged": len(merged),
+        "merge_s": merge_s,
+        "same_sites_merged": set(merged.index) == expected,
+        "same_name_merged": set(merge_stations(case).index) == case_expected,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""
+Compare the single pass price table parser on both HTML backends against the
+earlier parser, which scanned the cells of every row three times, on the
+recorded polttoaine.net fixture. Times fetch_changes, as run on each snapshot
+refresh, from the local stub for a first fetch and a fetch with one row
+changed, against fetching and parsing with the earlier parser. Also checks that
+fetching the table again with one row changed gives the same stations as a full
+parse of the changed table.
+
+    python -m benchmarks.parse
+"""
+import json
+import re
+import time
+import urllib.parse as urlparse
+from datetime import datetime
+from urllib.parse import parse_qs
+
+import pandas as pd
+import requests
+from bs4 import BeautifulSoup
+
+from benchmarks.stub import load_fixture, stubbed
+
+
+REPEAT = 20
+
+LEGACY_COLUMNS = ['Name', '95E10 Price', 'Timestamp', 'lat', 'lon']
+
+PRICE = re.compile(r'(title="95E10">)(\d+\.\d+)')
+
+
+def station_locations():
+    return {station["id"]: {
+        "name": station["nimi"],
+        "lat": station["lat"],
+        "lon": station["lon"]
+    } for station in json.loads(load_fixture('station_locations.json'))}
+
+
+def provider():
+    """ PolttoaineNet reading station locations from the fixture """
+    from src.parse import PolttoaineNet
+
+    return PolttoaineNet(station_locations(), record_history=False)
+
+
+def _legacy_station(row, locations):
+    for cell in row.find_all("td"):
+        anchor = cell.find("a")
+        if not anchor or len(cell.contents) < 2:
+            return {}
+        id = parse_qs(urlparse.urlparse(anchor["href"]).query).get("id")
+        id = id[0] if id else None
+        station = {"id": id, "name": cell.contents[2]}
+        station.update(locations.get(id, {}))
+        return station
+    return {}
+
+
+def _legacy_price(row):
+    for cell in row.find_all("td"):
+        if cell.get("title") == "95E10":
+            try:
+                return float(cell.contents[0])
+            except ValueError:
+                return None
+    return None
+
+
+def _legacy_timestamp(row):
+    for cell in row.find_all("td"):
+        if cell.attrs and not set(cell.attrs.get("class")).isdisjoint({"Pvm", "PvmTd"}):
+            day, month = cell.contents[0][:-1].split(".")
+            return datetime.now().replace(month=int(month), day=int(day))
+    return None
+
+
+def legacy_parse(html, locations):
+    """ Parser before the single pass rewrite, kept as the reference """
+    soup = BeautifulSoup(html, 'html.parser')
+    index, data = [], []
+    for row in soup.find(id="Hinnat").find("table").find_all("tr"):
+        station = _legacy_station(row, locations)
+        if not station.get("id"):
+            continue
+        index.append(station["id"])
+        data.append([station["name"], _legacy_price(row), _legacy_timestamp(row),
+                     station.get("lat"), station.get("lon")])
+    return pd.DataFrame(data, index=index, columns=LEGACY_COLUMNS) \
+        .dropna(subset=['95E10 Price', 'lat', 'lon']) \
+        .astype({"95E10 Price": float, "lat": float, "lon": float})
+
+
+def _time(function):
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        result = function()
+    return (time.perf_counter() - start) / REPEAT, result
+
+
+def _comparable(stations):
+    """ Columns and rows the legacy parser produced, which only knew 95E10 """
+    stations = stations.dropna(subset=['95E10 Price'])[LEGACY_COLUMNS]
+    return stations.assign(Timestamp=stations["Timestamp"].dt.date)
+
+
+def _by_date(stations):
+    # Timestamps take their time of day from the moment of parsing
+    return stations.assign(Timestamp=stations["Timestamp"].dt.date)
+
+
+def _raise_first_price(stub, amount=0.1):
+    stub.html = PRICE.sub(
+        lambda match: f'{match.group(1)}{float(match.group(2)) + amount:.3f}',
+        stub.html, count=1
+    )
+
+
+def time_fetch_changes(stub):
+    """ Seconds fetch_changes takes on a first fetch and with one row changed """
+    from src.parse import DATA, HEADER
+
+    locations = station_locations()
+    legacy_s, _ = _time(lambda: legacy_parse(requests.post(
+        f'{stub.url}/index.php', headers=HEADER, data=DATA
+    ).text, locations))
+    first_s, (stations, _) = _time(lambda: provider().fetch_changes())
+    polttoaine_net = provider()
+    polttoaine_net.fetch_changes()
+
+    def fetch_changed():
+        _raise_first_price(stub, 0.001)
+        return polttoaine_net.fetch_changes()
+
+    changed_s, (changed, _) = _time(fetch_changed)
+    return {
+        "legacy_s": legacy_s,
+        "first_s": first_s,
+        "first_speedup": legacy_s / first_s,
+        "rows": len(stations),
+        "one_changed_s": changed_s,
+        "one_changed_speedup": legacy_s / changed_s,
+        "changed_rows": len(changed),
+    }
+
+
+def check_incremental(stub):
+    """ Refetch the table with the first 95E10 price raised, against a full parse """
+    polttoaine_net = provider()
+    polttoaine_net.fetch_stations()
+    _raise_first_price(stub)
+    changed, removed = polttoaine_net.fetch_changes()
+    full = provider().fetch_stations()
+    return {
+        "changed": len(changed),
+        "removed": len(removed),
+        "same_output": _by_date(polttoaine_net.stations).equals(_by_date(full)),
+    }
+
+
+def compare_backends():
+    from src import parse
+
+    html = load_fixture('polttoaine_net.html')
+    polttoaine_net = provider()
+    legacy_s, expected = _time(
+        lambda: legacy_parse(html, polttoaine_net.station_locations)
+    )
+    backends = {"legacy": {"seconds": legacy_s, "rows": len(expected)}}
+    for name, rows in (("soup", parse._soup_rows), ("lxml", parse._lxml_rows)):
+        if name == "lxml" and not parse.lxml:
+            continue
+        seconds, stations = _time(lambda: polttoaine_net._parse_table(rows(html)))
+        backends[name] = {
+            "seconds": seconds,
+            "rows": len(stations),
+            "speedup": legacy_s / seconds,
+            "same_output": _comparable(stations).equals(_comparable(expected)),
+        }
+    return backends
+
+
+def main():
+    # Modules of src are imported inside, settings point to the stub
+    with stubbed() as stub:
+        results = compare_backends()
+        results["fetch_changes"] = time_fetch_changes(stub)
+        results["incremental"] = check_incremental(stub)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
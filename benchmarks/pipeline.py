@@ -0,0 +1,158 @@
+"""
+Run the whole pipeline, from scraping station prices to ranking them, against
+a local stub of Bing Maps and polttoaine.net serving recorded fixtures. Point
+and route mode are both run with an empty data folder and then again with the
+caches left by the first run. Wall time, requests by endpoint and peak memory
+traced by tracemalloc, of what the stage allocated, are reported as JSON for
+each stage, to compare between commits. Ranking is timed as a whole and by
+each of the stages src.metrics times within it, geocode, routing, filtering,
+pricing and ranking, routing including the geocoding of the addresses routed
+between. Requests are counted by endpoint, Locations for geocoding and Routes
+and DistanceMatrix for routing. Each scenario also checks
+that the ranking routing only as many stations as the limit needs equals the
+top of the exhaustive ranking, after its stages are measured.
+
+    python -m benchmarks.pipeline --latency 0.05 --output before.json
+"""
+import contextlib
+import io
+import json
+import os
+import subprocess
+import time
+import tracemalloc
+
+import click
+
+from benchmarks.stub import stubbed
+
+
+SCENARIOS = [
+    ("point-cold", "Helsinki", True),
+    ("point-warm", "Helsinki", False),
+    ("route-cold", ("Helsinki", "Lahti"), True),
+    ("route-warm", ("Helsinki", "Lahti"), False),
+]
+
+QUERY = {"amount": 40, "consumption": 7.2, "age": 5, "limit": 10}
+
+POINT_DISTANCE = 20  # Km
+
+ROUTE_DISTANCE = 1.5  # Km
+
+
+def _metrics_seconds():
+    from src.metrics import METRICS
+
+    return {stage: timing["seconds"]
+            for stage, timing in METRICS.summary()["stages"].items()}
+
+
+def _stage(stages, name, stub, function, *args):
+    before = stub.counts()
+    timed = _metrics_seconds()
+    # Resets the peak too, reset_peak needs Python 3.9
+    tracemalloc.clear_traces()
+    start = time.perf_counter()
+    result = function(*args)
+    wall = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    stages[name] = {
+        "wall_s": wall,
+        "stages_s": {stage: seconds - timed.get(stage, 0)
+                     for stage, seconds in _metrics_seconds().items()
+                     if seconds != timed.get(stage, 0)},
+        "requests": stub.requests_since(before),
+        "peak_bytes": peak,
+    }
+    return result
+
+
+def _total(stages):
+    requests, timed = {}, {}
+    for stage in stages.values():
+        for endpoint, count in stage["requests"].items():
+            requests[endpoint] = requests.get(endpoint, 0) + count
+        for name, seconds in stage["stages_s"].items():
+            timed[name] = timed.get(name, 0) + seconds
+    return {
+        "wall_s": sum(stage["wall_s"] for stage in stages.values()),
+        "stages_s": timed,
+        "requests": requests,
+        "peak_bytes": max(stage["peak_bytes"] for stage in stages.values()),
+    }
+
+
+def run_scenario(stub, location, cold):
+    # Imported late, settings are read from the environment pointing to the stub
+    from src.calc import PriceCalculator
+    from src.providers import configured_provider
+
+    if cold:
+        stub.clear_data()
+    distance = ROUTE_DISTANCE if isinstance(location, tuple) else POINT_DISTANCE
+    stages = {}
+    provider = _stage(stages, "locations", stub, configured_provider)
+    stations = _stage(stages, "scrape", stub, provider.fetch_stations)
+    index = _stage(stages, "index", stub, lambda: provider.index)
+
+    def rank():
+        calculator = PriceCalculator(location, QUERY["amount"], QUERY["consumption"],
+                                     distance, QUERY["age"])
+        return calculator.calculate_prices(stations, index, limit=QUERY["limit"])
+
+    _, ranked = _stage(stages, "rank", stub, rank)
+    return {"stations": len(stations), "ranked": len(ranked), "stages": stages,
+            "total": _total(stages),
+            "exact": matches_exhaustive(stations, index, location, distance, ranked)}
+
+
+def matches_exhaustive(stations, index, location, distance, ranked):
+    """ Whether the top of ranked equals the limit cheapest of all stations """
+    from src.cache import RouteCache
+    from src.calc import PriceCalculator
+
+    # A route cache given is not written, so later scenarios find the caches
+    # the measured runs left
+    calculator = PriceCalculator(location, QUERY["amount"], QUERY["consumption"],
+                                 distance, QUERY["age"], route_cache=RouteCache('data'))
+    _, exhaustive = calculator.calculate_prices(stations, index)
+    top, ranked = exhaustive.head(QUERY["limit"]), ranked.head(QUERY["limit"])
+    return list(top.index) == list(ranked.index) and \
+        top["Total price"].tolist() == ranked["Total price"].tolist()
+
+
+def _commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(__file__), check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.command()
+@click.option('--latency', default=0.02, help='Seconds stub waits before answering')
+@click.option('--scenario', '-s', multiple=True,
+              help='Scenarios to run, all by default. Warm ones need their cold run')
+@click.option('--output', '-o', type=click.File('w'), default='-',
+              help='File to write results to, stdout by default')
+def main(latency, scenario, output):
+    """ Benchmark pipeline stages against stubbed services """
+    results = {"commit": _commit(), "latency_s": latency, "scenarios": {}}
+    tracemalloc.start()
+    try:
+        with stubbed(latency) as stub:
+            for name, location, cold in SCENARIOS:
+                if scenario and name not in scenario:
+                    continue
+                with contextlib.redirect_stdout(io.StringIO()):
+                    results["scenarios"][name] = run_scenario(stub, location, cold)
+    finally:
+        tracemalloc.stop()
+    output.write(json.dumps(results, indent=2) + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Compare column-wise price computation against the earlier per-row one, which
+built a Series for every station, merged them back on the index and filtered
+by price age with a row-wise apply, on synthetic stations and routes.
+
+    python -m benchmarks.pricing
+"""
+import json
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from src.calc import PriceCalculator
+from src.providers import DEFAULT_FUEL
+
+
+STATIONS = 5000
+
+REPEAT = 5
+
+
+def calculator(amount=40, consumption=7.2, age=5):
+    """ PriceCalculator without router, cache or console pane """
+    price_calculator = PriceCalculator.__new__(PriceCalculator)
+    price_calculator.amount = amount
+    price_calculator.consumption = consumption
+    price_calculator.age = age
+    price_calculator.fuel = DEFAULT_FUEL
+    return price_calculator
+
+
+def synthetic_stations(rng, count=STATIONS):
+    now = datetime.now()
+    stations = pd.DataFrame({
+        "Name": [f'Station {i}' for i in range(count)],
+        "95E10 Price": np.round(1.4 + rng.random(count) * 0.4, 3),
+        "Timestamp": [now - timedelta(days=int(days))
+                      for days in rng.integers(0, 10, count)],
+        "lat": 60 + rng.random(count),
+        "lon": 24 + rng.random(count),
+    }, index=[str(i) for i in range(count)])
+    routes = [(distance, distance * 1.1, None) for distance in rng.random(count) * 40]
+    return stations, routes
+
+
+def legacy_prices(price_calculator, stations, routes):
+    now = datetime.now()
+    stations = stations[stations.apply(
+        lambda row: (now - row["Timestamp"]).days <= price_calculator.age, axis=1
+    )]
+    routes = dict(zip(stations.index, routes))
+    amount, consumption = price_calculator.amount, price_calculator.consumption
+
+    def calc(row, route):
+        price = row["95E10 Price"]
+        distance, duration, _ = route
+        total_price = ((consumption / 100) * distance * 2 * price) + amount * price \
+            if price and distance else None
+        return pd.Series({
+            "Distance": f'{round(distance * 2)}',
+            "Duration": f'{round(duration * 2)}',
+            "Total price": total_price,
+            f"{amount}l price": amount * price if price else None
+        })
+
+    return stations.merge(
+        stations.apply(lambda x: calc(x, routes[x.name]), axis=1),
+        left_index=True, right_index=True
+    )
+
+
+def prices(price_calculator, stations, routes):
+    stations = price_calculator.filter_stations(stations)
+    return price_calculator.price_stations(stations, routes[:len(stations)])
+
+
+def _time(function, *args):
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        result = function(*args)
+    return (time.perf_counter() - start) / REPEAT, result
+
+
+def main():
+    stations, routes = synthetic_stations(np.random.default_rng(0))
+    price_calculator = calculator()
+    legacy_s, expected = _time(legacy_prices, price_calculator, stations, routes)
+    columns_s, result = _time(prices, price_calculator, stations, routes)
+    print(json.dumps({
+        "stations": STATIONS,
+        "legacy_s": legacy_s,
+        "column_wise_s": columns_s,
+        "speedup": legacy_s / columns_s,
+        "same_result": bool(expected.equals(result)),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
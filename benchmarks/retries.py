@@ -0,0 +1,122 @@
+"""
+Check how routing copes with Bing Maps throttling and failing, against the
+local stub answering requests with 429 and 503: retries after Retry-After,
+giving up after the retries, routing budgets running out and /api answering
+such rankings as partial without caching them.
+
+    python -m benchmarks.retries
+"""
+import json
+import os
+import time
+
+from benchmarks.stub import BING_PATH, stubbed
+
+
+BUDGET = 10  # Requests per query in the /api check
+
+BODY = {"from": "60.1699,24.9384", "distance": 10, "age": 5, "amount": 40,
+        "consumption": 7.2, "limit": 3}
+
+
+def _retries():
+    from src.metrics import METRICS
+
+    return sum(METRICS.summary()["counters"]["api_retries"].values())
+
+
+def check_throttled(stub):
+    """ Geocode with the first two attempts throttled for a second each """
+    from src.route import Router, Scheduler
+
+    router = Router(budget=0, scheduler=Scheduler(rate=0, retries=3))
+    stub.fail_next(2, 429, retry_after=1)
+    before, retries = stub.counts(), _retries()
+    start = time.perf_counter()
+    point = router.get_point("Helsinki")
+    seconds = time.perf_counter() - start
+    return {
+        "requests": stub.requests_since(before),
+        "retries": _retries() - retries,
+        "waited_retry_after": seconds >= 2,
+        "geocoded": list(point) == stub.places["Helsinki"],
+        "partial": router.budget.partial,
+    }
+
+
+def check_given_up(stub):
+    """ Geocode with every attempt failing, given up on after two retries """
+    from src.route import Router, Scheduler
+
+    router = Router(budget=0, scheduler=Scheduler(rate=0, retries=2))
+    stub.fail_next(10, 503)
+    before = stub.counts()
+    point = router.get_point("Espoo")
+    stub.fail_next(0)
+    return {
+        "requests": stub.requests_since(before),
+        "geocoded": point != (None, None),
+        "partial": router.budget.partial,
+    }
+
+
+def check_budget(stub):
+    """ Route five pairs one by one with a budget of two requests """
+    from src.cache import RouteCache
+    from src.route import Router
+
+    router = Router(matrix=False, budget=2)
+    pairs = [(BODY["from"], f'60.{i}0,25.00') for i in range(2, 7)]
+    before = stub.counts()
+    routes = router.get_distances(pairs, RouteCache('data'))
+    return {
+        "requests": stub.requests_since(before),
+        "routed": sum(route[0] is not None for route in routes),
+        "exhausted": router.exhausted,
+        "partial": router.budget.partial,
+    }
+
+
+def check_api(stub):
+    """ /api with routing failing until the budget runs out, then recovered """
+    from fastapi.testclient import TestClient
+
+    import server
+
+    with TestClient(server.app) as client:
+        stub.fail_next(1000, 503, path=f'{BING_PATH}/Routes')
+        before = stub.counts()
+        failing = client.post("/api", json=BODY)
+        made = stub.requests_since(before)
+        stub.fail_next(0)
+        recovered = client.post("/api", json=BODY)
+    return {
+        "failing": {
+            "requests": made,
+            "within_budget": sum(made.values()) <= BUDGET,
+            "partial": failing.headers.get("X-Partial") == "true",
+            "etag": "ETag" in failing.headers,
+        },
+        "recovered": {
+            "stations": len(recovered.json()),
+            "partial": recovered.headers.get("X-Partial") == "true",
+            "etag": "ETag" in recovered.headers,
+        },
+    }
+
+
+def main():
+    # Settings are read on import of src, so they are set first
+    os.environ.update({"QUERY_BUDGET": str(BUDGET), "ROUTER_RETRIES": "1"})
+    with stubbed() as stub:
+        results = {
+            "throttled": check_throttled(stub),
+            "given_up": check_given_up(stub),
+            "budget": check_budget(stub),
+            "api": check_api(stub),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Compare size and load time of route cache entries with route paths stored as
+coordinate lists and as simplified, encoded polylines.
+
+    python -m benchmarks.route_paths
+"""
+import json
+import time
+from datetime import datetime
+
+import numpy as np
+
+from src.polyline import decode, encode, simplify
+
+
+ROUTES = 200
+POINTS = 4000  # Points in a route, Bing returns one every few hundred metres
+TOLERANCE = 30  # Metres, PATH_TOLERANCE of the default 1.5km corridor
+
+
+def _route(rng):
+    steps = rng.normal(0, 0.0005, (POINTS, 2)) + [0.0008, 0.0002]
+    return (np.cumsum(steps, axis=0) + [60.17, 24.94]).round(6).tolist()
+
+
+def _entries(paths):
+    now = datetime.now().isoformat()
+    return {f'start-{i}': {
+        "distance": 100, "duration": 60, "timestamp": now, "route_path": path
+    } for i, path in enumerate(paths)}
+
+
+def _load(dump, decode_paths=False):
+    start = time.perf_counter()
+    entries = json.loads(dump)
+    if decode_paths:
+        for entry in entries.values():
+            decode(entry["route_path"])
+    return time.perf_counter() - start
+
+
+def main():
+    rng = np.random.default_rng(0)
+    paths = [_route(rng) for _ in range(ROUTES)]
+    lists = json.dumps(_entries(paths))
+    encoded = json.dumps(_entries([encode(path) for path in paths]))
+    simplified = json.dumps(
+        _entries([encode(simplify(path, TOLERANCE)) for path in paths])
+    )
+
+    results = {
+        "lists": {"bytes": len(lists), "load_s": _load(lists)},
+        "encoded": {"bytes": len(encoded), "load_s": _load(encoded, True)},
+        "simplified": {"bytes": len(simplified), "load_s": _load(simplified, True)},
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+Rank stations around Helsinki and along the route to Lahti with the local
+router over the bundled sample road graph and with Bing, stubbed locally with
+configurable latency. Reports wall time, requests made and how many of the ten
+cheapest stations both agree on. The sample graph is a synthetic street grid
+over Helsinki and Lahti joined by a highway, regenerated with --write-sample.
+
+    python -m benchmarks.routing --latency 0.05
+"""
+import contextlib
+import io
+import json
+import os
+import time
+
+import click
+import numpy as np
+
+from benchmarks.stub import FIXTURES, stubbed
+
+
+SAMPLE_GRAPH = os.path.join(FIXTURES, 'sample_graph.npz')
+
+GRIDS = [  # South, west, north, east and step in degrees of latitude, longitude
+    (60.13, 24.55, 60.42, 25.25, 0.01, 0.02),
+    (60.93, 25.55, 61.03, 25.77, 0.01, 0.02),
+]
+
+HIGHWAY = [(60.42, 25.11), (60.60, 25.25), (60.80, 25.45), (60.93, 25.63)]
+
+HIGHWAY_STEP = 0.02  # Degrees of latitude between highway vertices
+
+QUERIES = [
+    ("point", "Helsinki", 20),
+    ("route", ("Helsinki", "Lahti"), 1.5),
+]
+
+TOP = 10
+
+
+def _grid(south, west, north, east, lat_step, lon_step):
+    lats = np.round(np.arange(south, north + lat_step / 2, lat_step), 7)
+    lons = np.round(np.arange(west, east + lon_step / 2, lon_step), 7)
+    rows = [[[lon, lat] for lon in lons] for lat in lats]
+    columns = [[[lon, lat] for lat in lats] for lon in lons]
+    return rows + columns
+
+
+def sample_roads():
+    """ GeoJSON of the sample road network """
+    streets = [line for grid in GRIDS for line in _grid(*grid)]
+    highway = []
+    for (lat1, lon1), (lat2, lon2) in zip(HIGHWAY, HIGHWAY[1:]):
+        steps = max(int(round((lat2 - lat1) / HIGHWAY_STEP)), 1)
+        highway.extend([round(lon1 + (lon2 - lon1) * i / steps, 7),
+                        round(lat1 + (lat2 - lat1) * i / steps, 7)]
+                       for i in range(steps))
+    highway.append([HIGHWAY[-1][1], HIGHWAY[-1][0]])
+    features = [{"type": "Feature", "properties": {},
+                 "geometry": {"type": "LineString", "coordinates": line}}
+                for line in streets]
+    features.append({"type": "Feature", "properties": {"maxspeed": "100"},
+                     "geometry": {"type": "LineString", "coordinates": highway}})
+    return {"type": "FeatureCollection", "features": features}
+
+
+def rank(stations, index, location, distance, router):
+    from src.calc import PriceCalculator
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        calculator = PriceCalculator(location, 40, 7.2, distance, 5, router=router)
+        start = time.perf_counter()
+        _, ranked = calculator.calculate_prices(stations, index, limit=TOP)
+    return time.perf_counter() - start, ranked
+
+
+def _run(stub, stations, index, location, distance, router):
+    stub.clear_data()
+    before = stub.counts()
+    wall, ranked = rank(stations, index, location, distance, router)
+    return {
+        "wall_s": wall,
+        "requests": stub.requests_since(before),
+        "ranked": len(ranked),
+    }, ranked
+
+
+@click.command()
+@click.option('--latency', default=0.02, help='Seconds stub waits before answering')
+@click.option('--write-sample', is_flag=True, help='Regenerate the sample graph')
+def main(latency, write_sample):
+    """ Compare the local router against stubbed Bing """
+    results = {"latency_s": latency}
+    with stubbed(latency) as stub:
+        # Imported late, settings are read from the environment pointing to the stub
+        from src.graph import LocalRouter, RoadGraph, graph_from_geojson
+        from src.providers import configured_provider
+        from src.route import Router
+
+        if write_sample:
+            graph_from_geojson(sample_roads()).save(SAMPLE_GRAPH)
+        provider = configured_provider()
+        stations = provider.fetch_stations()
+        graph = RoadGraph.load(SAMPLE_GRAPH)
+        for name, location, distance in QUERIES:
+            bing, bing_ranked = _run(stub, stations, provider.index, location,
+                                     distance, Router())
+            local, local_ranked = _run(stub, stations, provider.index, location,
+                                       distance, LocalRouter(graph))
+            results[name] = {
+                "bing": bing,
+                "local": local,
+                "top_agreement": len(set(bing_ranked.head(TOP).index) &
+                                     set(local_ranked.head(TOP).index)) /
+                max(min(TOP, len(bing_ranked)), 1),
+            }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
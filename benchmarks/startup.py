@@ -0,0 +1,51 @@
+"""
+Measure wall time of whole CLI runs: gasoline.py --help, and a point query with
+caches warmed by a previous run, against the local stub of Bing Maps and
+polttoaine.net.
+
+    python -m benchmarks.startup
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import click
+
+from benchmarks.stub import stubbed
+
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'gasoline.py')
+
+
+def _run(arguments, env):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, SCRIPT, *arguments], env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def _times(arguments, env, repeat):
+    times = [_run(arguments, env) for _ in range(repeat)]
+    return {"median_s": statistics.median(times), "min_s": min(times)}
+
+
+@click.command()
+@click.option('--repeat', default=5, help='Runs of each command')
+def main(repeat):
+    """ Benchmark CLI startup and warm cache query """
+    with stubbed() as stub:
+        env = dict(os.environ, **stub.environment())
+        # Warms route and station location caches for the query runs
+        _run(['Helsinki'], env)
+        results = {
+            "help": _times(['--help'], env, repeat),
+            "warm_query": _times(['Helsinki'], env, repeat),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
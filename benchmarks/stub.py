@@ -0,0 +1,269 @@
+"""
+Local stand-in for Bing Maps REST services and polttoaine.net, serving recorded
+fixtures with configurable latency, so benchmarks never touch live services.
+Routes follow straight lines between the points, with road distances a fixed
+factor longer. Nothing from src is imported here, so settings can be pointed to
+the stub before they are read.
+"""
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+import numpy as np
+
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+ROAD_FACTOR = 1.3  # Road distance compared to straight line distance
+
+SPEED = 80  # Km/h
+
+PATH_POINTS = 400  # Points in a route path
+
+BING_PATH = '/REST/v1'
+
+KM_PER_DEGREE = 111.32
+
+DATE = re.compile(r'(class="PvmTd">)(\d+)\.(\d+)\.')
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding='utf-8') as file:
+        return file.read()
+
+
+def _point(location, places):
+    if location in places:
+        return places[location]
+    lat, lon = location.split(',')
+    return float(lat), float(lon)
+
+
+def _distance(start, end):
+    """ Road distance in km, from equirectangular approximation of the line """
+    lat = np.radians((start[0] + end[0]) / 2)
+    dx = (end[1] - start[1]) * KM_PER_DEGREE * np.cos(lat)
+    dy = (end[0] - start[0]) * KM_PER_DEGREE
+    return float(np.hypot(dx, dy)) * ROAD_FACTOR
+
+
+def _path(start, end):
+    """ Straight line with a gentle wiggle, so simplifying it has some work """
+    t = np.linspace(0, 1, PATH_POINTS)
+    lat = start[0] + t * (end[0] - start[0]) + 0.002 * np.sin(t * 40)
+    lon = start[1] + t * (end[1] - start[1])
+    return np.round(np.column_stack([lat, lon]), 6).tolist()
+
+
+def _shift_dates(html, today=None):
+    """ Move price dates so that the newest one is today, keeping their spacing """
+    today = today or datetime.now()
+    dates = [datetime(today.year, int(month), int(day))
+             for _, day, month in DATE.findall(html)]
+    if not dates:
+        return html
+    shift = datetime(today.year, today.month, today.day) - max(dates)
+
+    def replace(match):
+        date = datetime(today.year, int(match.group(3)), int(match.group(2))) + shift
+        return f'{match.group(1)}{date.day}.{date.month}.'
+
+    return DATE.sub(replace, html)
+
+
+class StubServer(object):
+    """
+    Serve fixtures on a free local port in a background thread. Requests are
+    counted by endpoint and each one is answered after latency seconds. Bing
+    Maps requests can be made to fail, see fail_next.
+    """
+    def __init__(self, latency=0, places=None, data_folder=None):
+        self.latency = latency
+        self.places = places or {}
+        self.data_folder = data_folder
+        self.html = _shift_dates(load_fixture('polttoaine_net.html'))
+        self.station_locations = load_fixture('station_locations.json')
+        self.hits = {}
+        self.failures = []
+        self.failing_path = BING_PATH
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    @property
+    def bing_url(self):
+        return f'{self.url}{BING_PATH}'
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def counts(self):
+        with self._lock:
+            return dict(self.hits)
+
+    def requests_since(self, before):
+        """ Requests by endpoint made since counts were before """
+        return {endpoint: count - before.get(endpoint, 0)
+                for endpoint, count in self.counts().items()
+                if count != before.get(endpoint, 0)}
+
+    def fail_next(self, count, status=429, retry_after=None, path=BING_PATH):
+        """
+        Answer the next count Bing Maps requests under path with status and
+        Retry-After header when given, like throttling or server errors. They
+        are counted as the endpoint followed by the status.
+        """
+        headers = {'Retry-After': str(retry_after)} if retry_after is not None else {}
+        with self._lock:
+            self.failures = [(status, headers)] * count
+            self.failing_path = path
+
+    def _take_failure(self, path):
+        """ Status and headers to fail request to path with, None to answer it """
+        with self._lock:
+            if not self.failures or not path.startswith(self.failing_path):
+                return None
+            return self.failures.pop()
+
+    def environment(self):
+        """ Settings pointing to the stub and its data folder """
+        return {
+            "BING_URL": self.bing_url,
+            "BING_KEY": "benchmark",
+            "ROUTER_RATE": "0",  # The stub does not throttle
+            "POLTTOAINE_URL": self.url,
+            "DATA_FOLDER": self.data_folder,
+        }
+
+    def clear_data(self):
+        """ Empty the data folder, for a run with cold caches """
+        shutil.rmtree(self.data_folder, ignore_errors=True)
+
+    def _count(self, endpoint):
+        with self._lock:
+            self.hits[endpoint] = self.hits.get(endpoint, 0) + 1
+
+    def respond(self, method, path, query):
+        """ Return endpoint name, content type and body for request """
+        if path.startswith(f'{BING_PATH}/Locations/'):
+            address = unquote(path[len(f'{BING_PATH}/Locations/'):])
+            lat, lon = _point(address, self.places)
+            return 'Locations', 'application/json', {"resourceSets": [{"resources": [
+                {"point": {"coordinates": [lat, lon]}}
+            ]}]}
+        if path == f'{BING_PATH}/Routes/DistanceMatrix':
+            return 'DistanceMatrix', 'application/json', self._matrix(query)
+        if path.rstrip('/') == f'{BING_PATH}/Routes':
+            return 'Routes', 'application/json', self._route(query)
+        if method == 'POST' and path == '/index.php':
+            return 'polttoaine.net', 'text/html', self.html
+        if method == 'POST' and path == '/ajax.php':
+            return 'polttoaine.net/ajax', 'application/json', self.station_locations
+        return None, None, None
+
+    def _matrix(self, query):
+        origins = [_point(o, self.places) for o in query["origins"].split(';')]
+        destinations = [_point(d, self.places) for d in query["destinations"].split(';')]
+        results = []
+        for i, origin in enumerate(origins):
+            for j, destination in enumerate(destinations):
+                distance = _distance(origin, destination)
+                results.append({
+                    "originIndex": i, "destinationIndex": j,
+                    "travelDistance": distance, "travelDuration": distance / SPEED * 60
+                })
+        return {"resourceSets": [{"resources": [{"results": results}]}]}
+
+    def _route(self, query):
+        start = _point(query["wayPoint.1"], self.places)
+        end = _point(query["wayPoint.2"], self.places)
+        distance = _distance(start, end)
+        return {"resourceSets": [{"resources": [{
+            "travelDistance": distance,
+            "travelDuration": distance / SPEED * 3600,
+            "routePath": {"line": {"coordinates": _path(start, end)}}
+        }]}]}
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self._respond('GET')
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                self.rfile.read(length)
+                self._respond('POST')
+
+            def _respond(self, method):
+                url = urlparse(self.path)
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                try:
+                    endpoint, content_type, body = stub.respond(method, url.path, query)
+                except (KeyError, ValueError):
+                    endpoint, content_type, body = None, None, None
+                time.sleep(stub.latency)
+                if endpoint is None:
+                    self.send_error(404)
+                    return
+                failure = stub._take_failure(url.path)
+                if failure:
+                    status, headers = failure
+                    stub._count(f'{endpoint} {status}')
+                    _write(self, status, headers)
+                    return
+                stub._count(endpoint)
+                if not isinstance(body, str):
+                    body = json.dumps(body)
+                _write(self, 200, {'Content-Type': f'{content_type}; charset=utf-8'},
+                       body.encode('utf-8'))
+
+        return Handler
+
+
+def _write(handler, status, headers, data=b''):
+    handler.send_response(status)
+    for name, value in headers.items():
+        handler.send_header(name, value)
+    handler.send_header('Content-Length', str(len(data)))
+    handler.end_headers()
+    handler.wfile.write(data)
+
+
+@contextmanager
+def stubbed(latency=0):
+    """
+    Run a stub knowing the recorded places, with a temporary data folder, and
+    point settings to them. Modules of src read settings on import, so they
+    are imported inside the block.
+    """
+    stub = StubServer(latency, json.loads(load_fixture('places.json')),
+                      tempfile.mkdtemp(prefix='gasoline-benchmark-')).start()
+    os.environ.update(stub.environment())
+    try:
+        yield stub
+    finally:
+        stub.stop()
+        stub.clear_data()
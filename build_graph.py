@@ -0,0 +1,22 @@
+import json
+
+import click
+
+from src.graph import DEFAULT_SPEED, graph_from_geojson
+from src.UI import console
+
+
+@click.command()
+@click.argument('roads', type=click.File('r'))
+@click.argument('output', type=click.Path(dir_okay=False, writable=True))
+@click.option('--speed', '-s', default=DEFAULT_SPEED, help='Speed of roads without ' +
+              f'maxspeed in km/h ({DEFAULT_SPEED})')
+def main(roads, output, speed):
+    """ Build road graph for local routing from GeoJSON roads """
+    graph = graph_from_geojson(json.load(roads), speed)
+    graph.save(output)
+    console.print(f'Wrote {len(graph)} nodes and {len(graph.targets)} edges to {output}')
+
+
+if __name__ == '__main__':
+    main()
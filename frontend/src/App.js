@@ -12,7 +12,13 @@ const BASE_URL =
     ? "http://localhost:8000/api"
     : `https://${new URL(window.location).hostname}/api`;
 
-const api = axios.create({ baseURL: BASE_URL });
+const api = axios.create({
+  baseURL: BASE_URL,
+  validateStatus: (status) => (status >= 200 && status < 300) || status === 304,
+});
+
+// Latest response for each query, revalidated with its ETag
+const responses = {};
 
 const INITAL_STATE = {
   from: "",
@@ -69,8 +75,17 @@ const App = () => {
     try {
       setLoading({ ...loading, form: true });
       setIntervalValue(40 * 10);
-      const { data } = await api.post("", formData);
-      setStations(data);
+      const key = JSON.stringify(formData);
+      const cached = responses[key];
+      const { status, data, headers } = await api.post("", formData, {
+        headers: cached ? { "If-None-Match": cached.etag } : {},
+      });
+      if (status === 304) {
+        setStations(cached.data);
+      } else {
+        if (headers.etag) responses[key] = { etag: headers.etag, data };
+        setStations(data);
+      }
       resetFormLoading();
     } catch (e) {
       console.log(e);
@@ -8,14 +8,33 @@ from rich.panel import Panel
 from rich.table import Table
 from rich.text import Text
 
-from src.calc import PriceCalculator
-from src.parse import PolttoaineNet
+from src.metrics import METRICS
+from src.settings import STREAM_BATCH
 from src.UI import console
 
 
-providers = [PolttoaineNet()]
+_provider = None
 
-parsed = PolttoaineNet()
+
+def get_provider():
+    """ Provider merging all configured ones, constructed once on first use """
+    global _provider
+    if _provider is None:
+        # Imported here, so --help and invalid arguments do not wait for pandas
+        from src.providers import configured_provider
+        try:
+            _provider = configured_provider()
+        except RuntimeError as error:
+            raise click.ClickException(str(error))
+    return _provider
+
+
+def fetch_stations(provider):
+    """ Fetch stations, exiting with an error when no provider could be reached """
+    try:
+        return provider.fetch_stations()
+    except RuntimeError as error:
+        raise click.ClickException(f'{error}, see the log above')
 
 
 def get_style_for_row(index):
@@ -42,21 +61,28 @@ def get_maps_link(row, location):
         f'{urllib.parse.urlencode(url_params)}]'
 
 
-def print_stations(stations, amount, location):
+def print_stations(stations, amount, location, fuel='95E10', litres=40):
+    console.print(stations_table(stations, amount, location, fuel, litres))
+
+
+def stations_table(stations, amount, location, fuel='95E10', litres=40):
+    from src.providers import price_column
+    column = price_column(fuel)
     index = 0
     grid = Table(box=box.MINIMAL)
     grid.add_column()
     grid.add_column(Text('Station name and address', style="grey58"), justify="left",
                     no_wrap=True)
-    grid.add_column(Text('95E10', style="grey58"), justify="center")
-    grid.add_column(Text(f'40l {Emoji("car")}', style="grey58"), justify="center")
-    grid.add_column(Text(f'40l {Emoji("fuelpump")}', style="grey58"), justify="center")
+    grid.add_column(Text(fuel, style="grey58"), justify="center")
+    grid.add_column(Text(f'{litres}l {Emoji("car")}', style="grey58"), justify="center")
+    grid.add_column(Text(f'{litres}l {Emoji("fuelpump")}', style="grey58"),
+                    justify="center")
     grid.add_column(Text('Recorded', style="grey58"))
     grid.add_column(Text('Dist (m)/Dur (min)', style="grey58"))
 
     for i, row in stations.head(amount).iterrows():
         style = get_style_for_row(index)
-        price_style = style if row["95E10 Price"] < 1.45 else 'red1'
+        price_style = style if row[column] < 1.45 else 'red1'
         name = (row["Name"][:45] + '...') if len(row["Name"]) > 48 else row["Name"]
         time_str = _format_timestamp(row["Timestamp"])
         grid.add_row(
@@ -65,14 +91,41 @@ def print_stations(stations, amount, location):
                 get_maps_link(row, location) +
                 f'{name}[/link]', style=style
             ),
-            Text(str(row["95E10 Price"]), style=price_style),
+            Text(str(row[column]), style=price_style),
             Text(str(row["Total price"]), style=price_style),
-            Text(str(row["40l price"]), style=price_style),
+            Text(str(row[f"{litres}l price"]), style=price_style),
             Text(time_str, style=price_style),
             Text(f'{row["Distance"]}, {row["Duration"]}', style=price_style)
         )
         index += 1
+    return grid
+
+
+def print_timings():
+    summary = METRICS.summary()
+    grid = Table(box=box.MINIMAL)
+    grid.add_column(Text('Stage', style="grey58"))
+    grid.add_column(Text('Count', style="grey58"), justify="right")
+    grid.add_column(Text('Total (s)', style="grey58"), justify="right")
+    grid.add_column(Text('Mean (ms)', style="grey58"), justify="right")
+    for stage, timing in summary["stages"].items():
+        grid.add_row(stage, str(timing["count"]), f'{timing["seconds"]:.3f}',
+                     f'{timing["seconds"] / timing["count"] * 1000:.1f}')
     console.print(grid)
+    requests = ", ".join(f'{endpoint} {count}' for endpoint, count
+                         in summary["counters"]["api_requests"].items())
+    lookups = ", ".join(f'{count} {result}' for result, count
+                        in summary["counters"]["route_cache_lookups"].items())
+    console.print(Panel.fit(
+        f'Requests: {requests or "-"}\nRoute cache: {lookups or "-"}'
+    ))
+
+
+def print_partial():
+    console.print(Panel.fit(
+        'Routing budget ran out, rankings are partial and stations left '
+        'unrouted may be cheaper', style="yellow"
+    ))
 
 
 def _format_timestamp(timestamp):
@@ -81,6 +134,93 @@ def _format_timestamp(timestamp):
         f'{(now-timestamp).days} day{"s" if((now-timestamp).days > 1) else ""} ago'
 
 
+def calculate_live(calculator, stations, index, count, location, fuels):
+    """
+    Rank stations for fuels, showing the ranking of the first fuel so far after
+    each routed batch
+    """
+    for route_data, rankings in calculator.iter_rankings(
+        stations, index, limit=count, batch_size=STREAM_BATCH, fuels=fuels
+    ):
+        if not rankings[fuels[0]].empty:
+            calculator.update_preview(stations_table(
+                rankings[fuels[0]], count, location, fuels[0], calculator.amount
+            ))
+    calculator.update_preview()
+    return route_data, rankings
+
+
+def rank_batch(file, defaults, timings=False):
+    """ Rank stations for each query in file, scraping prices once """
+    from src.batch import BatchRanker, read_queries
+    try:
+        queries = read_queries(file, defaults)
+    except ValueError as error:
+        raise click.BadParameter(str(error), param_hint="'--batch'")
+    provider = get_provider()
+    console.print(Panel.fit(
+        f'Fetching prices from {provider} for {len(queries)} queries'
+    ))
+    stations = fetch_stations(provider)
+    ranker = BatchRanker(stations, provider.index)
+    results = ranker.rank(queries)
+    for i, (query, (route_data, calculated_data), partial) in enumerate(
+        zip(queries, results, ranker.partial)
+    ):
+        location = (query["from"], query["to"]) if query["to"] else query["from"]
+        title = f'{i + 1}. {query["from"]}' + \
+            (f' --> {query["to"]}' if query["to"] else '') + f' ({query["fuel"]})'
+        if route_data:
+            title += f', route {route_data["distance"]}km and ' + \
+                f'{route_data["duration"]}min'
+        console.print(Panel.fit(title))
+        if calculated_data.empty:
+            console.print('No stations found :(')
+        else:
+            print_stations(calculated_data, query["limit"] or len(calculated_data),
+                           location, query["fuel"], query["amount"])
+        if partial:
+            print_partial()
+    stats = ranker.stats
+    console.print(Panel.fit(
+        f'{stats["queries"]} queries in {stats["seconds"]:.2f}s '
+        f'({stats["queries_per_second"] or 0:.1f} queries/s), '
+        f'{stats["addresses"]} addresses, {stats["route_pairs"]} route pairs, '
+        f'{stats["requests"]} api requests, {stats["partial"]} partial rankings'
+    ))
+    if timings:
+        print_timings()
+
+
+def print_rankings(calculator, route_data, rankings, count, location):
+    if route_data:
+        console.print(
+            Panel.fit(f'Best route is {route_data["distance"]}km and '
+                      f'{route_data["duration"]}min')
+        )
+    for fuel_name, calculated_data in rankings.items():
+        title = f' ({fuel_name})' if len(rankings) > 1 else ''
+        if calculated_data.empty:
+            console.print(Panel.fit(f'No stations found{title} :('))
+        else:
+            console.print(Panel.fit(f'Best stations for you{title}'))
+            print_stations(calculated_data, count, location, fuel_name,
+                           calculator.amount)
+    if calculator.partial:
+        print_partial()
+
+
+def validate_fuels(context, parameter, value):
+    from src.providers import FUELS
+    unknown = [fuel for fuel in value if fuel not in FUELS]
+    if unknown:
+        raise click.BadParameter(
+            f'{", ".join(unknown)}, choose from {", ".join(FUELS)}'
+        )
+    # Repeated ones are ranked once, in the order first given
+    return list(dict.fromkeys(value))
+
+
 @click.command()
 @click.option('--count', '-c', default=10, help='Number of stations to display (10)')
 @click.option('--age', default=5, help='Ignore given days older price records (5)')
@@ -91,10 +231,27 @@ def _format_timestamp(timestamp):
 @click.option('--distance', '-d', default=0, help='Radius from given location to ' +
               'include stations, or in router mode distance from optimal route. ' +
               'Defaults to 20km, in route mode 1.5km')
+@click.option('--live', '-l', is_flag=True, help='Show provisional ranking while ' +
+              'stations are being routed')
+@click.option('--timings', is_flag=True, help='Show time spent in each stage and ' +
+              'requests made')
+@click.option('--fuel', '-f', multiple=True, default=['95E10'], callback=validate_fuels,
+              help='Fuel to rank stations by, 95E10, 98E5 or Diesel. Repeat to ' +
+              'rank several from the same routes (95E10)')
+@click.option('--batch', '-b', type=click.File('r'), help='Rank stations for each ' +
+              'query in a CSV or JSON lines file with fields from, to, amount, ' +
+              'consumption, distance, age, limit and fuel, instead of location. ' +
+              'Other options are defaults for fields not given')
 @click.argument('location', nargs=-1)
-def main(count, location, age, to, amount, consumption, distance):
+def main(count, location, age, to, amount, consumption, distance, live, timings,
+         fuel, batch):
     """ Fetch cheapest gas station for you based on given location """
     location = " ".join(location)
+    if batch:
+        rank_batch(batch, {"to": to, "amount": amount, "consumption": consumption,
+                           "distance": distance, "age": age, "limit": count,
+                           "fuel": fuel[0]}, timings)
+        return
     if not location.strip():
         console.print(
             Panel.fit('You need to provide location where from fetch stations!')
@@ -110,25 +267,26 @@ def main(count, location, age, to, amount, consumption, distance):
     else:
         distance = 20 if not distance else float(distance)
     age = 5 if age < 0 or age > 5 else age
-    calculator = PriceCalculator(location, amount, consumption, distance, age)
-    for provider in providers:
-        location_str = location if not isinstance(location, tuple) else \
-            f'{location[0]} --> {location[1]}'
-        console.print(
-            Panel.fit(f'Fetching prices from {provider} using location {location_str}')
+    from src.calc import PriceCalculator
+    calculator = PriceCalculator(location, amount, consumption, distance, age, fuel[0])
+    provider = get_provider()
+    location_str = location if not isinstance(location, tuple) else \
+        f'{location[0]} --> {location[1]}'
+    console.print(
+        Panel.fit(f'Fetching prices from {provider} using location {location_str}')
+    )
+    stations = fetch_stations(provider)
+    if live:
+        route_data, rankings = calculate_live(
+            calculator, stations, provider.index, count, location, fuel
         )
-        stations = provider.fetch_stations()
-        route_data, calculated_data = calculator.calculate_prices(stations)
-        if route_data:
-            console.print(
-                Panel.fit(f'Best route is {route_data["distance"]}km and '
-                          f'{route_data["duration"]}min')
-            )
-        if calculated_data.empty:
-            console.print(Panel.fit('No stations found :('))
-        else:
-            console.print(Panel.fit('Best stations for you'))
-            print_stations(calculated_data, count, location)
+    else:
+        route_data, rankings = calculator.calculate_rankings(
+            stations, provider.index, limit=count, fuels=fuel
+        )
+    print_rankings(calculator, route_data, rankings, count, location)
+    if timings:
+        print_timings()
 
 
 if __name__ == '__main__':
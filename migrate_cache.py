@@ -0,0 +1,23 @@
+import os
+
+import click
+
+from src.cache import RouteCache
+from src.UI import console
+
+
+@click.command()
+@click.option('--tolerance', '-t', default=0.0, help='Simplify route paths by given ' +
+              'metres (0)')
+def main(tolerance):
+    """ Store cached route paths as simplified, encoded polylines """
+    route_cache = RouteCache('data')
+    path = route_cache.routes._get_cache_path()
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    count = route_cache.migrate(tolerance)
+    new_size = os.path.getsize(path) if os.path.exists(path) else 0
+    console.print(f'Migrated {count} routes in {path}, {size} -> {new_size} bytes')
+
+
+if __name__ == '__main__':
+    main()
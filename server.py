@@ -1,17 +1,38 @@
+import asyncio
 import json
-from fastapi import Request, FastAPI
+import math
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from fastapi import Request, Response, FastAPI, HTTPException
 from datetime import datetime
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 
+from src.batch import BatchRanker, normalize_query
+from src.cache import RouteCache, normalize_address
 from src.calc import PriceCalculator
-from src.parse import PolttoaineNet
-from src.settings import DEV
+from src.metrics import METRICS
+from src.providers import DEFAULT_FUEL, FUELS, configured_provider, price_column
+from src.response_cache import ResponseCache
+from src.route import create_router
+from src.settings import (
+    API_WORKERS, DEV, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL,
+    SNAPSHOT_REFRESH_INTERVAL, STREAM_BATCH
+)
+from src.snapshot import StationSnapshot
 
 app = FastAPI()
 
+snapshot = None
+
+executor = ThreadPoolExecutor(max_workers=API_WORKERS)
+
+responses = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
 if DEV:
     origins = ['*']
 
@@ -21,6 +42,7 @@ if DEV:
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
+        expose_headers=["X-Snapshot-Age", "ETag", "X-Partial"],
     )
 
 app.mount("/static", StaticFiles(directory="frontend/build/static"), name="static")
@@ -34,20 +56,240 @@ def _format_timestamp(timestamp):
         f'{(now-timestamp).days} day{"s" if((now-timestamp).days > 1) else ""} ago'
 
 
-def stationToJSON(s):
+def _price(value):
+    # NaN for missing prices is not valid JSON
+    return None if value is None or math.isnan(value) else value
+
+
+def _text(value):
+    # Columns of routes all missing hold NaN rather than None
+    return value if isinstance(value, str) else None
+
+
+def stationToJSON(s, fuel=DEFAULT_FUEL, amount=40):
     time_str = _format_timestamp(s["Timestamp"])
     return {
         "name": s["Name"],
-        "95E10/l": s["95E10 Price"],
+        "fuel": fuel,
+        "price": _price(s[price_column(fuel)]),
+        "95E10/l": _price(s.get(price_column(DEFAULT_FUEL))),
         "price_age": time_str,
-        "total_price": s["Total price"],
-        "only_gas": s["40l price"],
+        "total_price": _price(s["Total price"]),
+        "only_gas": _price(s[f"{amount}l price"]),
         "lat": s["lat"],
         "lon": s["lon"],
-        "distance": s["Distance"],
-        "durations": s["Duration"],
+        "distance": _text(s["Distance"]),
+        "durations": _text(s["Duration"]),
     }
 
+
+def count_route_cache():
+    RouteCache('data').update_gauge()
+
+
+async def refresh_snapshot():
+    while True:
+        await asyncio.sleep(SNAPSHOT_REFRESH_INTERVAL)
+        await run_in_threadpool(snapshot.refresh)
+        await run_in_threadpool(count_route_cache)
+
+
+@app.on_event("startup")
+async def load_snapshot():
+    global snapshot
+    # Built on refresh, so the app starts, answering 503, while prices are down
+    snapshot = StationSnapshot(create_provider=configured_provider)
+    await run_in_threadpool(snapshot.refresh)
+    await run_in_threadpool(count_route_cache)
+    app.state.refresh_task = asyncio.create_task(refresh_snapshot())
+
+
+class SingleFlight(object):
+    """
+    Run blocking function in the worker pool, sharing one run between concurrent
+    calls with the same key.
+    """
+    def __init__(self):
+        self.flights = {}
+
+    async def run(self, key, function, *args):
+        flight = self.flights.get(key)
+        if flight is None:
+            loop = asyncio.get_event_loop()
+            flight = asyncio.ensure_future(
+                loop.run_in_executor(executor, function, *args)
+            )
+            self.flights[key] = flight
+            flight.add_done_callback(lambda _: self.flights.pop(key, None))
+        # Shielded, so a client going away does not cancel the run for the others
+        return await asyncio.shield(flight)
+
+
+flights = SingleFlight()
+
+
+class RouterPool(object):
+    """
+    Routers and route caches kept between queries, so their HTTP sessions and
+    SQLite connections are reused. A query takes a pair for its whole run, as a
+    router holds the routing budget of one query at a time, and the route cache
+    is written when it is given back. Pairs beyond size are dropped then.
+    """
+    def __init__(self, size):
+        self.idle = queue.LifoQueue(maxsize=size)
+
+    @contextmanager
+    def take(self):
+        try:
+            router, route_cache = self.idle.get_nowait()
+        except queue.Empty:
+            router, route_cache = create_router(), RouteCache('data')
+        router.reset_budget()
+        route_cache.origins.clear()
+        try:
+            yield router, route_cache
+        finally:
+            route_cache.write_cache()
+            try:
+                self.idle.put_nowait((router, route_cache))
+            except queue.Full:
+                pass
+
+
+routers = RouterPool(API_WORKERS)
+
+
+def query_key(body):
+    """ Normalized query, equal for requests giving the same ranking """
+    to = body.get("to")
+    return (
+        normalize_address(body["from"]),
+        normalize_address(to) if to else None,
+        float(body["distance"]),
+        int(body["age"]),
+        float(body["amount"]),
+        float(body["consumption"]),
+        body.get("limit"),
+        _fuel(body),
+    )
+
+
+def _fuel(body):
+    fuel = body.get("fuel") or DEFAULT_FUEL
+    if fuel not in FUELS:
+        raise HTTPException(status_code=400,
+                            detail=f"Unknown fuel {fuel}, one of {', '.join(FUELS)}")
+    return fuel
+
+
+def _calculator(body, router, route_cache):
+    location = body["from"]
+    if "to" in body and body["to"]:
+        location = (location, body["to"])
+    age = body["age"]
+    distance = body["distance"]
+    amount = body["amount"]
+    consumption = body["consumption"]
+    return PriceCalculator(location, amount, consumption, distance, age, _fuel(body),
+                           router=router, route_cache=route_cache)
+
+
+def _age_headers():
+    """ Snapshot age header, left out before the first successful refresh """
+    age = snapshot.age
+    return {"X-Snapshot-Age": str(round(age))} if age is not None else {}
+
+
+def _snapshot_stations():
+    stations = snapshot.get()
+    if stations is None:
+        raise HTTPException(status_code=503, detail="Station prices not available")
+    return stations
+
+
+def rank_stations(body):
+    """
+    Rank snapshot stations for query, blocking. Returns result with route
+    and stations and whether it is partial, the routing budget having run out.
+    """
+    stations = _snapshot_stations()
+    with routers.take() as (router, route_cache):
+        calculator = _calculator(body, router, route_cache)
+        with METRICS.timer("query"):
+            route_data, calculated_data = calculator.calculate_prices(
+                stations, snapshot.index, limit=body.get("limit")
+            )
+    print(calculated_data)
+    return {"route": route_data, "stations": [
+        stationToJSON(s, calculator.fuel, calculator.amount)
+        for _, s in calculated_data.iterrows()
+    ]}, calculator.partial
+
+
+def rank_batch(queries):
+    """ Rank snapshot stations for each of queries sharing routes, blocking """
+    stations = _snapshot_stations()
+    with routers.take() as (router, route_cache):
+        ranker = BatchRanker(stations, snapshot.index, router, route_cache)
+        with METRICS.timer("query"):
+            results = ranker.rank(queries)
+    return {
+        "results": [
+            {
+                "route": route_data,
+                "stations": [stationToJSON(s, query["fuel"], query["amount"])
+                             for _, s in calculated_data.iterrows()],
+                "partial": partial,
+            }
+            for query, (route_data, calculated_data), partial
+            in zip(queries, results, ranker.partial)
+        ],
+        "stats": ranker.stats,
+    }
+
+
+def stream_stations(body, stations, key, version):
+    """
+    Yield NDJSON lines with provisional ranking of the stations routed so far,
+    as each batch of routes arrives, and a final line with the whole ranking.
+    """
+    count = body.get("limit") or 10
+    with routers.take() as (router, route_cache):
+        calculator = _calculator(body, router, route_cache)
+        for route_data, calculated_data in calculator.iter_prices(
+            stations, snapshot.index, limit=body.get("limit"), batch_size=STREAM_BATCH
+        ):
+            yield _ndjson({
+                "final": False,
+                "route": route_data,
+                "stations": [
+                    stationToJSON(s, calculator.fuel, calculator.amount)
+                    for _, s in calculated_data.head(count).iterrows()
+                ],
+            })
+    output = [stationToJSON(s, calculator.fuel, calculator.amount)
+              for _, s in calculated_data.iterrows()]
+    if not calculator.partial:
+        responses.set(key, version, {"route": route_data, "stations": output})
+    yield _ndjson({"final": True, "route": route_data, "stations": output,
+                   "partial": calculator.partial})
+
+
+async def _in_executor(lines):
+    """ Iterate blocking generator in the worker pool, a line at a time """
+    loop = asyncio.get_event_loop()
+    done = object()
+    while True:
+        line = await loop.run_in_executor(executor, next, lines, done)
+        if line is done:
+            return
+        yield line
+
+
+def _ndjson(line):
+    # Numpy scalars from the DataFrame rows are not JSON serializable as such
+    return json.dumps(line, default=lambda value: value.item()) + "\n"
+
 # Hack
 
 
@@ -66,28 +308,70 @@ async def logo():
     return FileResponse('frontend/build/logo.png')
 
 
+@app.get("/metrics")
+async def metrics():
+    return Response(METRICS.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/")
 async def serve_spa(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
 
 @app.post("/api")
-async def get_stations(request: Request):
+async def get_stations(request: Request, response: Response):
     body = await request.body()
     body = json.loads(body)
-    location = body["from"]
-    if "to" in body and body["to"]:
-        location = (location, body["to"])
-    age = body["age"]
-    distance = body["distance"]
-    amount = body["amount"]
-    consumption = body["consumption"]
-    calculator = PriceCalculator(location, amount, consumption, distance, age)
-    stations = PolttoaineNet().fetch_stations()
-    route_data, calculated_data = calculator.calculate_prices(stations)
-    print(calculated_data)
-    output = [
-        stationToJSON(s)
-        for _, s in calculated_data.iterrows()
-    ]
+    key = query_key(body)
+    version = snapshot.version
+    cached = responses.get(key, version)
+    if cached is None:
+        result, partial = await flights.run(key, rank_stations, body)
+        if partial:
+            # Not cached, the same query may route further with a fresh budget
+            response.headers.update({"X-Partial": "true", **_age_headers()})
+            return result["stations"]
+        cached = responses.set(key, version, result)
+    etag, result = cached
+    headers = {"ETag": etag, **_age_headers()}
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return result["stations"]
+
+
+@app.post("/api/batch")
+async def batch_stations(request: Request, response: Response):
+    body = await request.body()
+    body = json.loads(body)
+    try:
+        queries = [normalize_query(query) for query in body["queries"]]
+    except (KeyError, TypeError, ValueError) as error:
+        raise HTTPException(status_code=400, detail=f"Invalid queries: {error}")
+    loop = asyncio.get_event_loop()
+    output = await loop.run_in_executor(executor, rank_batch, queries)
+    response.headers.update(_age_headers())
     return output
+
+
+@app.post("/api/stream")
+async def stream_stations_endpoint(request: Request):
+    body = await request.body()
+    body = json.loads(body)
+    key = query_key(body)
+    version = snapshot.version
+    headers = _age_headers()
+    cached = responses.get(key, version)
+    if cached is not None:
+        etag, result = cached
+        line = _ndjson({"final": True, **result, "partial": False})
+        return StreamingResponse(
+            iter([line]), media_type="application/x-ndjson", headers=headers
+        )
+    loop = asyncio.get_event_loop()
+    stations = await loop.run_in_executor(executor, _snapshot_stations)
+    # Each routing step runs in the worker pool shared with the other endpoints
+    return StreamingResponse(
+        _in_executor(stream_stations(body, stations, key, version)),
+        media_type="application/x-ndjson", headers=headers
+    )
@@ -0,0 +1,182 @@
+import csv
+import io
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .cache import RouteCache, normalize_address
+from .calc import PriceCalculator
+from .metrics import METRICS
+from .providers import DEFAULT_FUEL, FUELS
+from .route import create_router
+from .spatial import parse_coordinates
+
+
+QUERY_DEFAULTS = {
+    "to": None,
+    "amount": 40,  # Litres
+    "consumption": 7.2,  # Litres per 100 km
+    "distance": None,  # Km, 20 from a point and 1.5 from a route when not given
+    "age": 5,  # Days
+    "limit": 10,
+    "fuel": DEFAULT_FUEL,
+}
+
+
+def read_queries(file, defaults=None):
+    """
+    Read queries from CSV with a header row or from JSON lines, with the same
+    fields as the body of /api. Missing fields are taken from defaults, and
+    from QUERY_DEFAULTS when not given there either.
+    """
+    text = file.read()
+    if text.lstrip().startswith('{'):
+        records = [json.loads(line) for line in text.splitlines() if line.strip()]
+    else:
+        records = list(csv.DictReader(io.StringIO(text)))
+    return [normalize_query(record, defaults) for record in records]
+
+
+def normalize_query(record, defaults=None):
+    """
+    Return query with defaults filled in and numbers parsed, raising ValueError
+    for queries without location or with an unknown fuel
+    """
+    given = {key: value for key, value in record.items()
+             if value is not None and value != ''}
+    query = {**QUERY_DEFAULTS, **(defaults or {}), **given}
+    query["from"] = str(query.get("from") or '').strip()
+    query["to"] = str(query["to"]).strip() if query["to"] else None
+    if not query["from"]:
+        raise ValueError(f'Query without from: {record}')
+    if query["fuel"] not in FUELS:
+        raise ValueError(f'Unknown fuel {query["fuel"]}, one of {", ".join(FUELS)}')
+    if not query["distance"]:
+        query["distance"] = 1.5 if query["to"] else 20
+    for key in ("amount", "consumption", "distance"):
+        query[key] = _number(query[key])
+    query["age"] = int(query["age"])
+    query["limit"] = int(query["limit"]) if query["limit"] else None
+    return query
+
+
+def _number(value):
+    # Whole numbers stay integers, so price columns are named like 40l price
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+
+class BatchRanker(object):
+    """
+    Rank stations for many queries against one table of stations, sharing one
+    router and route cache. Addresses of all queries are geocoded first and the
+    route pairs of their first routing round fetched next, each unique one once
+    and together, so ranking each query mostly reads the cache. The cache is
+    written once at the end. Each query is ranked with a routing budget of
+    its own, see src.route.Budget. Fetching ahead for all queries is limited
+    by their budgets together, and its requests are charged evenly to them.
+    """
+    def __init__(self, stations, index, router=None, route_cache=None):
+        self.stations = stations
+        self.index = index
+        self.router = router if router is not None else create_router()
+        self.route_cache = route_cache if route_cache is not None \
+            else RouteCache('data')
+        self.partial = []
+        self.stats = {}
+
+    def rank(self, queries):
+        """
+        Rank stations for each query, see normalize_query. Returns list of
+        (route data, ranked stations) in the order of the queries and sets
+        whether each ranking is partial and stats of the run.
+        """
+        start = time.perf_counter()
+        requests = self.router.count
+        prefetch = self.router.reset_budget(self.router.budget_limit * len(queries))
+        queries = self._canonical(queries)
+        calculators = [self._calculator(query) for query in queries]
+        addresses = self._geocode(queries)
+        self._route(calculators)
+        pairs = list(dict.fromkeys(
+            pair for calculator, query in zip(calculators, queries)
+            for pair in calculator.planned_pairs(
+                self.stations, self.index, query["limit"]
+            )
+        ))
+        if pairs:
+            with METRICS.timer("routing"):
+                self.router.get_distances(pairs, self.route_cache)
+        results = []
+        charges = _shares(prefetch.spent, len(queries))
+        for calculator, query, charge in zip(calculators, queries, charges):
+            self.router.reset_budget().spent = charge
+            results.append(calculator.calculate_prices(self.stations, self.index,
+                                                       query["limit"]))
+        self.partial = [calculator.partial for calculator in calculators]
+        self.route_cache.write_cache()
+        seconds = time.perf_counter() - start
+        self.stats = {
+            "queries": len(queries),
+            "seconds": seconds,
+            "queries_per_second": len(queries) / seconds if seconds else None,
+            "addresses": addresses,
+            "route_pairs": len(pairs),
+            "requests": self.router.count - requests,
+            "partial": sum(self.partial),
+        }
+        return results
+
+    def _calculator(self, query):
+        location = (query["from"], query["to"]) if query["to"] else query["from"]
+        return PriceCalculator(
+            location, query["amount"], query["consumption"], query["distance"],
+            query["age"], query["fuel"], router=self.router,
+            route_cache=self.route_cache, quiet=True
+        )
+
+    def _canonical(self, queries):
+        """ Queries with addresses spelled like the first equal one """
+        spellings = {}
+
+        def canonical(address):
+            return spellings.setdefault(normalize_address(address), address) \
+                if address else address
+
+        return [dict(query, **{"from": canonical(query["from"]),
+                               "to": canonical(query["to"])})
+                for query in queries]
+
+    def _geocode(self, queries):
+        """ Geocode unique addresses of queries concurrently, return their count """
+        addresses = list(dict.fromkeys(
+            address for query in queries for address in (query["from"], query["to"])
+            if address and not parse_coordinates(address)
+        ))
+        with ThreadPoolExecutor(max_workers=self.router.concurrency) as executor:
+            list(executor.map(
+                lambda address: self.router.get_point(address, self.route_cache),
+                addresses
+            ))
+        return len(addresses)
+
+    def _route(self, calculators):
+        """ Route unique start and end pairs of route queries together """
+        tolerances = {}
+        for calculator in calculators:
+            if isinstance(calculator.location, tuple):
+                pair = calculator.location
+                tolerances[pair] = min(tolerances.get(pair, calculator.path_tolerance),
+                                       calculator.path_tolerance)
+        by_tolerance = {}
+        for pair, tolerance in tolerances.items():
+            by_tolerance.setdefault(tolerance, []).append(pair)
+        for tolerance, pairs in by_tolerance.items():
+            with METRICS.timer("routing"):
+                self.router.get_routes(pairs, self.route_cache, tolerance)
+
+
+def _shares(total, count):
+    """ Split total into count whole shares differing by at most one """
+    share, remainder = divmod(total, count) if count else (0, 0)
+    return [share + (i < remainder) for i in range(count)]
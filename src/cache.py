@@ -1,13 +1,51 @@
 import json
 import os
+import sqlite3
 import sys
 from datetime import datetime
+from threading import Lock
+
+import numpy as np
+
+from .metrics import METRICS
+from .polyline import decode, encode, simplify
+from .settings import CACHE_BACKEND, CACHE_GRID_SIZE, DATA_FOLDER
+from .spatial import parse_coordinates
 
 
 ROUTE_CACHE_EXPIRY = 7  # Days
 
 CACHE_FOLDER = 'data'
 
+SQLITE_TIMEOUT = 30  # Seconds to wait for other processes holding the write lock
+
+METRES_PER_DEGREE = 111320
+
+
+def normalize_address(address):
+    """ Address in lower case with whitespace collapsed """
+    return " ".join(address.casefold().split())
+
+
+def snap_coordinates(lat, lon, grid_size=CACHE_GRID_SIZE):
+    """ Snap coordinates to the centre of a grid_size metres grid cell """
+    if not grid_size:
+        return lat, lon
+    lat_step = grid_size / METRES_PER_DEGREE
+    lat = (np.floor(lat / lat_step) + 0.5) * lat_step
+    lon_step = grid_size / (METRES_PER_DEGREE * np.cos(np.radians(lat)))
+    lon = (np.floor(lon / lon_step) + 0.5) * lon_step
+    return lat, lon
+
+
+def get_data_folder_path():
+    """ Folder for caches and other data, next to the script being run """
+    if DATA_FOLDER:
+        return DATA_FOLDER
+    main_path = os.path.abspath(sys.modules['__main__'].__file__)
+    path = "/".join(main_path.split("/")[:-1])
+    return f'{path}/{CACHE_FOLDER}'
+
 
 class Cache(object):
     def __init__(self, prefix, name):
@@ -16,9 +54,7 @@ class Cache(object):
         self.cache = self._read_cache()
 
     def _get_cache_folder_path(self):
-        main_path = os.path.abspath(sys.modules['__main__'].__file__)
-        path = "/".join(main_path.split("/")[:-1])
-        return f'{path}/{CACHE_FOLDER}'
+        return get_data_folder_path()
 
     def _get_cache_path(self):
         path = self._get_cache_folder_path()
@@ -43,36 +79,254 @@ class Cache(object):
     def get(self, key):
         return self.cache.get(key)
 
+    def items(self):
+        return list(self.cache.items())
+
+    def delete(self, keys):
+        for key in keys:
+            self.cache.pop(key, None)
+
+    def __len__(self):
+        return len(self.cache)
+
+
+class SqliteCache(Cache):
+    """
+    Cache stored in an SQLite database in WAL mode. Keys are read one at a time
+    and updates are buffered until write_cache, which upserts them all in one
+    transaction, so several processes can share the same cache file.
+    """
+    def __init__(self, prefix, name):
+        self.prefix = prefix
+        self.file = name
+        self.pending = {}
+        self._lock = Lock()
+        self.connection = self._connect()
+
+    def _connect(self):
+        if not os.path.exists(self._get_cache_folder_path()):
+            os.makedirs(self._get_cache_folder_path(), exist_ok=True)
+        connection = sqlite3.connect(
+            self._get_cache_path(), timeout=SQLITE_TIMEOUT, check_same_thread=False,
+            isolation_level=None
+        )
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL)'
+        )
+        return connection
+
+    def import_json(self, name):
+        """ Copy entries of a JSON cache file with given name, if any, to database """
+        entries = Cache(self.prefix, name).cache
+        if entries:
+            self.update(entries)
+            self.write_cache()
+        return len(entries)
+
+    def write_cache(self):
+        with self._lock:
+            if not self.pending:
+                return
+            rows = [(key, json.dumps(value)) for key, value in self.pending.items()]
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)', rows
+                )
+                self.connection.execute('COMMIT')
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+            self.pending = {}
+
+    def update(self, obj):
+        with self._lock:
+            self.pending.update(obj)
+
+    def get(self, key):
+        with self._lock:
+            if key in self.pending:
+                return self.pending[key]
+            row = self.connection.execute(
+                'SELECT value FROM cache WHERE key = ?', (key,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def items(self):
+        with self._lock:
+            rows = self.connection.execute('SELECT key, value FROM cache').fetchall()
+            pending = dict(self.pending)
+        items = {key: json.loads(value) for key, value in rows}
+        items.update(pending)
+        return list(items.items())
+
+    def delete(self, keys):
+        with self._lock:
+            for key in keys:
+                self.pending.pop(key, None)
+            self.connection.executemany(
+                'DELETE FROM cache WHERE key = ?', [(key,) for key in keys]
+            )
+
+    def empty(self):
+        """ Whether the database holds no entries, without counting them """
+        with self._lock:
+            return self.connection.execute(
+                'SELECT 1 FROM cache LIMIT 1'
+            ).fetchone() is None
+
+    def __len__(self):
+        with self._lock:
+            return self.connection.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
 
 class RouteCache(object):
-    def __init__(self, prefix):
+    """
+    Cache for routes and geocoded addresses in separate key namespaces. Addresses
+    are normalized, and coordinates of query origins, see add_origin, snapped to
+    a grid of grid_size metres as start of routes, so nearby origins share
+    routes. Other locations, like stations, are never snapped. Lookups are
+    counted to hits, misses and expired entries.
+    """
+    def __init__(self, prefix, backend=CACHE_BACKEND, grid_size=CACHE_GRID_SIZE):
         self.prefix = prefix
-        self.routes = Cache(prefix, 'routes.json')
+        self.grid_size = grid_size
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.origins = set()
+        if backend == 'sqlite':
+            self.routes = SqliteCache(prefix, 'routes.sqlite3')
+            if self.routes.empty():
+                self.routes.import_json('routes.json')
+        else:
+            self.routes = Cache(prefix, 'routes.json')
 
-    def get_route_from_cache(self, start, end):
-        route = self.routes.get(f'{start}-{end}')
-        if not route:
+    def _location_key(self, location, snap=False):
+        coordinates = parse_coordinates(location)
+        if not coordinates:
+            return normalize_address(location)
+        lat, lon = snap_coordinates(*coordinates, self.grid_size) if snap \
+            else coordinates
+        return f'{lat:.5f},{lon:.5f}'
+
+    def add_origin(self, location):
+        """ Snap routes starting from location, the origin of a query """
+        self.origins.add(location)
+
+    def _route_key(self, start, end):
+        start_key = self._location_key(start, snap=start in self.origins)
+        return f'route:{start_key}-{self._location_key(end)}'
+
+    def _point_key(self, address):
+        return f'point:{self._location_key(address)}'
+
+    def _get_fresh(self, key):
+        entry = self.routes.get(key)
+        if not entry:
+            self._count("misses")
             return None
+        timestamp = datetime.fromisoformat(entry.get("timestamp"))
+        if (datetime.now() - timestamp).days >= ROUTE_CACHE_EXPIRY:
+            self._count("expired")
+            return None
+        return entry
+
+    def _count(self, result):
+        """ Count lookup as one of hits, misses and expired """
+        setattr(self, result, getattr(self, result) + 1)
+        METRICS.increment("route_cache_lookups", result)
 
-        now = datetime.now()
+    def stats(self):
+        lookups = self.hits + self.misses + self.expired
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "hit_ratio": self.hits / lookups if lookups else None,
+        }
 
-        route_timestamp = datetime.fromisoformat(route.get("timestamp"))
-        if (now - route_timestamp).days >= ROUTE_CACHE_EXPIRY:
+    def get_route_from_cache(self, start, end, tolerance=None):
+        """
+        Return cached distance, duration and route path. With tolerance the path
+        is needed, so routes cached without one, or with one simplified more than
+        tolerance metres, count as missing. Each lookup is counted once, by the
+        route returned.
+        """
+        route = self._get_fresh(self._route_key(start, end))
+        if not route:
             return None
-        return route.get("distance"), route.get("duration"), route.get("route_path")
+        if tolerance is not None and (route.get("route_path") is None or
+                                      route.get("tolerance", 0) > tolerance):
+            self._count("misses")
+            return None
+        self._count("hits")
+        route_path = route.get("route_path")
+        if isinstance(route_path, str):
+            route_path = decode(route_path)
+        return route.get("distance"), route.get("duration"), route_path
 
-    def add_route_to_cache(self, start, end, distance, duration, route_path):
-        payload = {f'{start}-{end}': {
+    def add_route_to_cache(self, start, end, distance, duration, route_path,
+                           tolerance=0):
+        """
+        Add route to cache. Route path is simplified to stay within tolerance
+        metres from the original and stored as an encoded polyline.
+        """
+        payload = {self._route_key(start, end): {
             "distance": distance,
             "duration": duration,
             "timestamp": datetime.now().isoformat(),
-            "route_path": route_path
+            "route_path": encode(simplify(route_path, tolerance))
+            if route_path is not None else None,
+            "tolerance": tolerance
         }}
         self.routes.update(payload)
 
+    def migrate(self, tolerance=0):
+        """
+        Migrate entries stored by earlier versions. Route paths stored as
+        coordinate lists are encoded and simplified with given tolerance, and
+        entries are moved from raw keys to namespaced keys. Routes whose start
+        and end can not be told apart from the raw key are dropped. Returns count
+        of migrated entries.
+        """
+        migrated = {}
+        legacy = []
+        for key, value in self.routes.items():
+            if not isinstance(value, dict):
+                continue
+            new_key = key
+            if not key.startswith(('route:', 'point:')):
+                legacy.append(key)
+                new_key = self._migrated_key(key, value)
+                if not new_key:
+                    continue
+            if isinstance(value.get("route_path"), list):
+                value = dict(
+                    value, route_path=encode(simplify(value["route_path"], tolerance)),
+                    tolerance=tolerance
+                )
+            elif new_key == key:
+                continue
+            migrated[new_key] = value
+        self.routes.delete(legacy)
+        self.routes.update(migrated)
+        self.routes.write_cache()
+        return len(migrated)
+
+    def _migrated_key(self, key, value):
+        if "lat" in value:
+            return self._point_key(key)
+        start, _, end = key.rpartition('-')
+        if not start or not parse_coordinates(end):
+            return None
+        return self._route_key(start, end)
+
     def add_point_to_cache(self, point, address):
         lat, lon = point
-        payload = {address: {
+        payload = {self._point_key(address): {
             "lat": lat,
             "lon": lon,
             "timestamp": datetime.now().isoformat()
@@ -80,15 +334,18 @@ class RouteCache(object):
         self.routes.update(payload)
 
     def get_point_from_cache(self, address):
-        point = self.routes.get(address)
+        point = self._get_fresh(self._point_key(address))
         if not point:
             return None
-
-        now = datetime.now()
-        point_timestamp = datetime.fromisoformat(point.get("timestamp"))
-        if (now - point_timestamp).days >= ROUTE_CACHE_EXPIRY:
-            return None
+        self._count("hits")
         return float(point.get("lat")), float(point.get("lon"))
 
     def write_cache(self):
         self.routes.write_cache()
+
+    def update_gauge(self):
+        """
+        Set the route_cache_entries gauge. Counting scans the whole cache, so
+        it is done periodically rather than on each write.
+        """
+        METRICS.set_gauge("route_cache_entries", len(self.routes))
@@ -1,147 +1,511 @@
 from datetime import datetime
-from functools import partial
 
+import numpy as np
 import pandas as pd
-import pyproj
 from rich.box import SIMPLE
 from rich.live_render import LiveRender
 from rich.panel import Panel
-from shapely.geometry import LineString, Point
-from shapely.ops import transform
+from rich.table import Table
 
 from .cache import RouteCache
-from .route import Router
+from .metrics import METRICS
+from .providers import DEFAULT_FUEL, FUELS, price_column
+from .route import MATRIX_CHUNK, create_router
+from .settings import DETOUR_CANDIDATES
+from .spatial import StationIndex, distance_to_line, haversine, project, project_stations
 from .UI import console
 
 
-PROJECTION = partial(
-    pyproj.transform,
-    pyproj.Proj('EPSG:4326'),
-    pyproj.Proj('EPSG:32633')
-)
+LOWER_BOUND_FACTOR = 0.95  # Share of straight line distance a route covers at least
+
+LOWER_BOUND_SLACK = 0.2  # km, routes start and end at the nearest road
+
+PATH_TOLERANCE = 0.02  # Share of corridor width route paths may be simplified by
+
+DETOUR_FACTOR = 1.3  # Road distance off the route and back per straight line metre
 
 
 class PriceCalculator(object):
-    def __init__(self, location, amount, consumption, distance, age):
+    def __init__(self, location, amount, consumption, distance, age,
+                 fuel=DEFAULT_FUEL, router=None, route_cache=None, quiet=False):
+        """
+        Router and route cache may be shared between calculators, see
+        src.batch. A route cache given is written by its owner, not after each
+        ranking. Quiet calculators show no request count or preview.
+        """
         super().__init__()
         self.location = location
+        self.fuel = fuel
         self.amount = amount
         self.consumption = consumption
         self.distance = distance * 1000
         self.age = age
-        self.route_cache = RouteCache('data')
-        self.router = Router()
+        self.index = None
+        self.origin = None
+        self.route_ends = None
+        self.detour_candidates = DETOUR_CANDIDATES
+        self.owns_cache = route_cache is None
+        self.route_cache = route_cache if route_cache is not None else RouteCache('data')
+        self.route_cache.add_origin(location[0] if isinstance(location, tuple)
+                                    else location)
+        self.router = router if router is not None else create_router()
+        self.budget = self.router.budget
+        self.quiet = quiet
+        self.count_panel = ""
+        self.preview = None
         self.pane = LiveRender("")
-        console.print(self.pane.position_cursor())
-        console.print(self.pane)
+        if not quiet:
+            console.print(self.pane.position_cursor())
+            console.print(self.pane)
 
     def update_count(self, count):
-        self.pane.set_renderable(Panel(f'Api requests made: {count}', box=SIMPLE))
+        stats = self.route_cache.stats()
+        hit_ratio = f'{stats["hit_ratio"]:.0%}' if stats["hit_ratio"] is not None \
+            else '-'
+        self.count_panel = Panel(
+            f'Api requests made: {count}, cache hits {stats["hits"]}/'
+            f'{stats["hits"] + stats["misses"] + stats["expired"]} ({hit_ratio})',
+            box=SIMPLE
+        )
+        self._render()
+
+    def update_preview(self, renderable=None):
+        """ Show renderable below the request count until replaced or cleared """
+        self.preview = renderable
+        self._render()
+
+    def _render(self):
+        if self.quiet:
+            return
+        renderable = self.count_panel
+        if self.preview is not None:
+            renderable = Table.grid()
+            renderable.add_row(self.count_panel)
+            renderable.add_row(self.preview)
+        self.pane.set_renderable(renderable)
         console.print(self.pane.position_cursor())
         console.print(self.pane)
 
-    def calc(self, row):
-        lat = row["lat"]
-        lon = row["lon"]
-        name = row["Name"]
-        price = row["95E10 Price"]
+    def price_stations(self, stations, routes, fuel=None):
+        """
+        Return copy of stations with price columns of fuel, the calculator fuel by
+        default, for round trips along routes, given as list of (distance,
+        duration, path) in the order of the stations.
+        """
+        distance, duration = _route_columns(routes)
+        price = stations[price_column(fuel or self.fuel)].to_numpy(dtype=float)
+        return stations.assign(**{
+            "Distance": _format_column(distance * 2),
+            "Duration": _format_column(duration * 2),
+            "Total price": self._total_prices(price, distance),
+            f"{self.amount}l price": self._fuel_prices(price),
+        })
 
-        route_query = f"{lat},{lon}" if lat and lon else f'{name} Helsinki'
-        distance, duration, route_path = self.router.get_route(
-            self.location, route_query, self.route_cache
+    def price_stations_via(self, stations, routes_to, routes_from,
+                           shortest_distance, shortest_duration, fuel=None):
+        """
+        Return copy of stations with price columns of fuel for detours via each
+        station, compared to the shortest route from start to end.
+        """
+        distance_to, duration_to = _route_columns(routes_to)
+        distance_from, duration_from = _route_columns(routes_from)
+        price = stations[price_column(fuel or self.fuel)].to_numpy(dtype=float)
+        distance_delta = distance_to + distance_from - shortest_distance
+        full_duration = np.round(duration_to + duration_from)
+        total_price = np.where(
+            price != 0,
+            (self.consumption / 100) * distance_delta * 2 * price + self.amount * price,
+            np.nan
         )
-        self.update_count(self.router.count)
-
-        total_price = ((self.consumption / 100) * distance * 2 * price) + self.amount \
-            * price if price and distance else None
-        gas_price = self.amount * price if price else None
-        return pd.Series({
-            "Distance": f'{round(distance * 2)}',
-            "Duration": f'{round(duration * 2)}',
+        return stations.assign(**{
+            "Distance": _format_column(distance_delta * 1000, '+{}m'),
+            "Duration": _format_column(full_duration - shortest_duration, '+{}min'),
             "Total price": total_price,
-            f"{self.amount}l price": gas_price
+            f"{self.amount}l price": self._fuel_prices(price),
         })
 
-    def cal_via(self, row, shortest_distance, shortest_duration):
-        lat = row["lat"]
-        lon = row["lon"]
-        price = row["95E10 Price"]
-        origin, destination = self.location
-
-        station = f"{lat},{lon}"
-        distance_from_origin, duration_from_origin, _ = \
-            self.router.get_route(origin, station, self.route_cache)
-        distance_from_station, duration_from_station, _ = \
-            self.router.get_route(station, destination, self.route_cache)
-        self.update_count(self.router.count)
+    def _total_prices(self, price, distance):
+        """ Round trip total price, NaN without price or distance like no route """
+        return np.where(
+            (price != 0) & (distance != 0),
+            (self.consumption / 100) * distance * 2 * price + self.amount * price,
+            np.nan
+        )
 
-        full_distance = distance_from_origin + distance_from_station
-        full_duration = round(duration_from_origin + duration_from_station)
-        distance_delta = full_distance - shortest_distance
-        total_price = ((self.consumption / 100) * distance_delta * 2 * price) \
-            + self.amount * price if price and distance_delta is not None else None
-        gas_price = self.amount * price if price else None
-        return pd.Series({
-            "Distance": f'+{round((distance_delta)*1000)}m',
-            "Duration": f'+{round(full_duration-shortest_duration)}min',
-            "Total price": total_price,
-            "40l price": gas_price
-        })
+    def _fuel_prices(self, price):
+        return np.where(price != 0, self.amount * price, np.nan)
+
+    def lower_bounds(self, stations, fuel=None):
+        """
+        Return lower bound of total price of fuel for each station from the
+        straight line distance between location and the station. Road distance is
+        never shorter, so no station can be cheaper than its bound.
+        """
+        lat, lon = self.origin
+        distance = haversine(lat, lon, stations["lat"].to_numpy(dtype=float),
+                             stations["lon"].to_numpy(dtype=float)) / 1000
+        distance = np.maximum(distance * LOWER_BOUND_FACTOR - LOWER_BOUND_SLACK, 0)
+        price = stations[price_column(fuel or self.fuel)].to_numpy(dtype=float)
+        return pd.Series(
+            (self.consumption / 100) * distance * 2 * price + self.amount * price,
+            index=stations.index
+        )
+
+    def iter_routes(self, stations, limit=None, batch_size=None, fuels=None):
+        """
+        Route from location to stations, yielding routes of each batch of at most
+        batch_size stations as dict by station id as soon as the batch is routed.
+        With limit, stations are routed in order of their lower bound and routing
+        stops once no remaining station can make it to the limit cheapest ones
+        of any of fuels, the calculator fuel by default. The stations left out
+        could never appear in the limit first rows of the exhaustive result.
+        """
+        fuels = fuels or [self.fuel]
+        queries = {id: _route_query(row) for id, row in stations.iterrows()}
+        order, batch_size, remaining = self._routing_order(
+            stations, limit, batch_size, fuels
+        )
+        totals = {fuel: [] for fuel in fuels}
+        for start in range(0, len(order), batch_size):
+            if self.router.exhausted or limit and all(
+                _ranked(totals[fuel], remaining[fuel][start], limit) for fuel in fuels
+            ):
+                break
+            batch = order[start:start + batch_size]
+            with METRICS.timer("routing"):
+                fetched = self.router.get_distances(
+                    [(self.location, queries[id]) for id in batch], self.route_cache
+                )
+            self.update_count(self.router.count)
+            for fuel in fuels:
+                batch_totals = self._total_prices(
+                    stations.loc[batch, price_column(fuel)].to_numpy(dtype=float),
+                    _route_columns(fetched)[0]
+                )
+                totals[fuel].extend(batch_totals[~np.isnan(batch_totals)])
+            yield dict(zip(batch, fetched))
+
+    def _routing_order(self, stations, limit, batch_size, fuels):
+        """
+        Order to route stations in, batch size and, with limit, the smallest
+        lower bound from each position of the order on by fuel. Stations are
+        ordered by lower bound with a limit or a routing budget.
+        """
+        if not limit and not self.router.budget.limit:
+            return stations.index, batch_size or len(stations), None
+        bounds = {fuel: self.lower_bounds(stations, fuel) for fuel in fuels}
+        order = bounds[fuels[0]].sort_values(kind="mergesort").index
+        remaining = {fuel: _suffix_minimum(bounds[fuel][order].to_numpy())
+                     for fuel in fuels}
+        return order, self._batch_size(batch_size, limit), remaining
+
+    def _batch_size(self, batch_size, limit):
+        if batch_size:
+            return batch_size
+        # A matrix request answers a whole chunk for the price of one call
+        if self.router.matrix:
+            return max(limit or 0, MATRIX_CHUNK)
+        return limit or MATRIX_CHUNK
+
+    def planned_pairs(self, stations, index=None, limit=None, fuels=None):
+        """
+        Return (start, end) pairs the first routing round of ranking stations
+        routes, so that pairs of many queries can be fetched together before
+        ranking each. Geocodes the location, and in route mode routes it.
+        """
+        fuels = fuels or [self.fuel]
+        self.index = index if index is not None else \
+            StationIndex.from_stations(stations)
+        stations = _priced_stations(stations, fuels)
+        if isinstance(self.location, tuple):
+            start, end = self.location
+            distance, _, stations_on_path, path = self._stations_on_route(stations)
+            if stations_on_path.empty:
+                return []
+            order, batch_size, _, _ = self._detour_order(
+                stations_on_path, path, distance, limit, None, fuels
+            )
+            queries = [_route_query(stations_on_path.loc[id])
+                       for id in order[:batch_size]]
+            return [(start, query) for query in queries] + \
+                [(query, end) for query in queries]
+        filtered_stations = self.filter_stations(stations, filter_by_distance=True)
+        if filtered_stations.empty:
+            return []
+        order, batch_size, _ = self._routing_order(filtered_stations, limit, None,
+                                                   fuels)
+        return [(self.location, _route_query(filtered_stations.loc[id]))
+                for id in order[:batch_size]]
 
     def filter_stations(self, stations, filter_by_distance=False):
-        notnull_stations = stations.merge(stations.apply(
-            lambda row: pd.Series({"point": _project(Point(row["lat"], row["lon"]))}),
-            axis=1
-        ), left_index=True, right_index=True)
-        now = datetime.now()
-        notnull_stations = notnull_stations[notnull_stations.apply(
-            lambda row: (now - row["Timestamp"]).days <= self.age, axis=1
-        )]
+        notnull_stations = stations
         if filter_by_distance:
             lat, lon = self.router.get_point(self.location, self.route_cache)
-            from_point = _project(Point(lat, lon))
-            notnull_stations = notnull_stations[notnull_stations.apply(
-                lambda row: row["point"].distance(from_point) <= self.distance, axis=1
-            )]
-        return notnull_stations
+            self.origin = lat, lon
+            if lat is None or lon is None:
+                return stations.iloc[:0]
+        with METRICS.timer("filtering"):
+            if filter_by_distance:
+                ids = self.index.within_distance(*project(lat, lon), self.distance)
+                notnull_stations = notnull_stations[notnull_stations.index.isin(ids)]
+            age = datetime.now() - notnull_stations["Timestamp"]
+            return notnull_stations[(age.dt.days <= self.age).to_numpy()]
 
-    def calc_via_route(self, stations):
+    def iter_via_route(self, stations, batch_size=None, fuels=None, limit=None):
+        """
+        Yield route data and dict of stations near the route with their prices
+        by fuel, after each batch of at most batch_size stations is routed.
+        With limit, stations are routed in order of their estimated detour
+        price, see _detour_order, and only as many as needed to rank the limit
+        cheapest ones, or at most detour_candidates times limit.
+        """
+        fuels = fuels or [self.fuel]
         start, end = self.location
-        distance, duration, route_path = \
-            self.router.get_route(start, end, self.route_cache)
+        distance, duration, stations_on_path, path = self._stations_on_route(stations)
+        route_data = {"distance": round(distance), "duration": round(duration)}
+        if stations_on_path.empty:
+            yield route_data, {}
+            return
+
+        routes_to, routes_from = {}, {}
+        order, batch_size, remaining, candidates = self._detour_order(
+            stations_on_path, path, distance, limit, batch_size, fuels
+        )
+        totals = {fuel: [] for fuel in fuels}
+        for first in range(0, len(order), batch_size):
+            if self.router.exhausted or limit and (first >= candidates or all(
+                _ranked(totals[fuel], remaining[fuel][first], limit) for fuel in fuels
+            )):
+                break
+            batch = stations_on_path.loc[order[first:first + batch_size]]
+            queries = [_route_query(row) for _, row in batch.iterrows()]
+            with METRICS.timer("routing"):
+                routes = self.router.get_distances(
+                    [(start, query) for query in queries] +
+                    [(query, end) for query in queries],
+                    self.route_cache
+                )
+            self.update_count(self.router.count)
+            routes_to.update(zip(batch.index, routes[:len(queries)]))
+            routes_from.update(zip(batch.index, routes[len(queries):]))
+            routed = stations_on_path[stations_on_path.index.isin(routes_to)]
+            with METRICS.timer("pricing"):
+                priced = {fuel: self.price_stations_via(
+                    routed, [routes_to[id] for id in routed.index],
+                    [routes_from[id] for id in routed.index], distance, duration, fuel
+                ) for fuel in fuels}
+            for fuel in fuels:
+                batch_totals = priced[fuel].loc[batch.index, "Total price"].to_numpy()
+                totals[fuel].extend(batch_totals[~np.isnan(batch_totals)])
+            yield route_data, priced
+        if not routes_to:
+            # The budget ran out before the first batch
+            yield route_data, {}
+
+    def _detour_order(self, stations, path, shortest_distance, limit, batch_size,
+                      fuels):
+        """
+        Order to route stations near the route in, batch size, with limit the
+        smallest lower bound of detour price from each position of the order on
+        by fuel, and the number of stations to route at most. Stations are
+        ordered by their price with a detour estimated from their distance to
+        the route path, and bounded by the straight line detour via them, with
+        a limit or a routing budget.
+        """
+        if not limit and not self.router.budget.limit:
+            return stations.index, batch_size or len(stations), None, len(stations)
+        projected = project_stations(stations)
+        x, y = projected["x"].to_numpy(), projected["y"].to_numpy()
+        offset = distance_to_line(x, y, *path) / 1000
+        lat = stations["lat"].to_numpy(dtype=float)
+        lon = stations["lon"].to_numpy(dtype=float)
+        (start_lat, start_lon), (end_lat, end_lon) = self.route_ends
+        straight = (haversine(start_lat, start_lon, lat, lon) +
+                    haversine(lat, lon, end_lat, end_lon)) / 1000
+        least = np.maximum(straight * LOWER_BOUND_FACTOR - shortest_distance, 0) - \
+            2 * LOWER_BOUND_SLACK
+        price = stations[price_column(fuels[0])].to_numpy(dtype=float)
+        estimate = pd.Series(self._detour_prices(price, 2 * offset * DETOUR_FACTOR),
+                             index=stations.index)
+        order = estimate.sort_values(kind="mergesort").index
+        remaining = {}
+        for fuel in fuels:
+            bounds = pd.Series(self._detour_prices(
+                stations[price_column(fuel)].to_numpy(dtype=float), least
+            ), index=stations.index)
+            remaining[fuel] = _suffix_minimum(bounds[order].to_numpy())
+        candidates = limit * self.detour_candidates \
+            if limit and self.detour_candidates else len(stations)
+        return order, self._batch_size(batch_size, limit), remaining, candidates
+
+    def _detour_prices(self, price, distance_delta):
+        """ Total price with a detour of distance_delta km, like price_stations_via """
+        return (self.consumption / 100) * distance_delta * 2 * price + \
+            self.amount * price
+
+    def _stations_on_route(self, stations):
+        """
+        Distance and duration of the route, stations near its path and the path
+        as projected x and y arrays
+        """
+        start, end = self.location
+        with METRICS.timer("routing"):
+            distance, duration, route_path = self.router.get_route(
+                start, end, self.route_cache, tolerance=self.path_tolerance
+            )
         self.update_count(self.router.count)
+        if route_path is None:
+            return 0, 0, stations.iloc[:0], None
 
-        line = _project(LineString(route_path))
-        notnull_stations = stations.merge(stations.apply(
-            lambda row: pd.Series({"point": _project(Point(row["lat"], row["lon"]))}),
-            axis=1
-        ), left_index=True, right_index=True)
+        with METRICS.timer("filtering"):
+            path = np.asarray(route_path, dtype=float)
+            self.route_ends = tuple(path[0]), tuple(path[-1])
+            line = project(path[:, 0], path[:, 1])
+            ids = self.index.within_distance_of_line(*line, self.distance)
+            return distance, duration, stations[stations.index.isin(ids)], line
 
-        stations_on_path = notnull_stations[notnull_stations.apply(
-            lambda x: line.distance(x["point"]) <= self.distance, axis=1
-        )]
-        return {"distance": round(distance), "duration": round(duration)}, \
-            stations_on_path.merge(stations_on_path.apply(lambda x: self.cal_via(
-                x, distance, duration), axis=1), left_index=True, right_index=True)
+    @property
+    def partial(self):
+        """
+        Whether the routing budget of the last ranking ran out, or requests
+        were given up on, leaving stations unrouted. Stations are routed most
+        promising first, so the ranking holds the best found within the
+        budget, with unrouted ones left out or ranked last.
+        """
+        return self.budget.partial
 
-    def calc_from_point(self, stations):
+    @property
+    def path_tolerance(self):
+        """ Metres the route path may be simplified by, within the corridor """
+        return self.distance * PATH_TOLERANCE
+
+    def iter_from_point(self, stations, limit=None, batch_size=None, fuels=None):
+        """
+        Yield dict of stations near location with their prices by fuel, after
+        each batch of stations is routed.
+        """
+        fuels = fuels or [self.fuel]
         filtered_stations = self.filter_stations(stations, filter_by_distance=True)
         if filtered_stations.empty:
-            return None, pd.DataFrame()
-        return None, filtered_stations.merge(
-            filtered_stations.apply(self.calc, axis=1), left_index=True, right_index=True
-        )
+            yield None, {}
+            return
+        routes = {}
+        for batch in self.iter_routes(filtered_stations, limit, batch_size, fuels):
+            routes.update(batch)
+            routed = filtered_stations[filtered_stations.index.isin(routes)]
+            route_list = [routes[id] for id in routed.index]
+            with METRICS.timer("pricing"):
+                priced = {fuel: self.price_stations(routed, route_list, fuel)
+                          for fuel in fuels}
+            yield None, priced
+        if not routes:
+            # The budget ran out before the first batch
+            yield None, {}
+
+    def calculate_prices(self, stations, index=None, limit=None):
+        """
+        Calculate prices for given stations. Index is a StationIndex covering the
+        stations, for example one kept by the provider, and is built on the fly
+        when not given. With limit, only as many stations are routed as needed
+        to rank the limit cheapest ones, and the rest are left out of the result.
+        """
+        return _last(self.iter_prices(stations, index, limit))
+
+    def iter_prices(self, stations, index=None, limit=None, batch_size=None):
+        """
+        Calculate prices like calculate_prices, yielding route data and ranking of
+        the stations priced so far after each batch of at most batch_size stations
+        is routed. The last ranking yielded is the final one.
+        """
+        for route_data, rankings in self.iter_rankings(stations, index, limit,
+                                                       batch_size):
+            yield route_data, rankings[self.fuel]
+
+    def calculate_rankings(self, stations, index=None, limit=None, fuels=None):
+        """
+        Rank stations like calculate_prices for each of fuels, the calculator
+        fuel by default, routing them once for all fuels. Returns route data and
+        dict of ranked stations by fuel.
+        """
+        return _last(self.iter_rankings(stations, index, limit, fuels=fuels))
+
+    def iter_rankings(self, stations, index=None, limit=None, batch_size=None,
+                      fuels=None):
+        """
+        Rank stations like calculate_rankings, yielding route data and rankings
+        of the stations priced so far after each batch is routed.
+        """
+        fuels = fuels or [self.fuel]
+        self.budget = self.router.budget
+        self.index = index if index is not None else \
+            StationIndex.from_stations(stations)
+        stations = _priced_stations(stations, fuels)
+        results = self.iter_from_point(stations, limit, batch_size, fuels) \
+            if not isinstance(self.location, tuple) else \
+            self.iter_via_route(stations, batch_size, fuels, limit)
+        for route_data, priced in results:
+            with METRICS.timer("ranking"):
+                rankings = {fuel: self._rank(priced.get(fuel, pd.DataFrame()), fuel)
+                            for fuel in fuels}
+            yield route_data, rankings
+        if self.owns_cache:
+            self.route_cache.write_cache()
 
-    def calculate_prices(self, stations):
-        route_data, updated_stations = self.calc_from_point(stations) \
-            if not isinstance(self.location, tuple) else self.calc_via_route(stations)
-        self.route_cache.write_cache()
+    def _rank(self, updated_stations, fuel=None):
+        column = price_column(fuel or self.fuel)
         if updated_stations.empty:
-            return route_data, pd.DataFrame()
-        return route_data, updated_stations \
-            .round({"Total price": 2, f"{self.amount}l price": 2, "95E10 Price": 3}) \
-            .sort_values("Total price")
+            return pd.DataFrame()
+        prices = {price_column(grade): 3 for grade in FUELS}
+        return updated_stations[updated_stations[column].notna()] \
+            .round({"Total price": 2, f"{self.amount}l price": 2, **prices}) \
+            .sort_values("Total price", kind="mergesort")
+
+
+def _priced_stations(stations, fuels):
+    """ Stations with a price for any of fuels, with a price column for each """
+    columns = [price_column(fuel) for fuel in fuels]
+    stations = stations.assign(**{
+        column: np.nan for column in columns if column not in stations.columns
+    })
+    return stations[stations[columns].notna().any(axis=1)]
+
+
+def _suffix_minimum(bounds):
+    """ Smallest bound from each position on, missing bounds never reached """
+    bounds = np.where(np.isnan(bounds), np.inf, bounds)
+    return np.minimum.accumulate(bounds[::-1])[::-1]
+
+
+def _ranked(totals, bound, limit):
+    """
+    Whether limit cheapest totals are known, when no remaining station can cost
+    less than bound. Equal once rounded could still win a tie, so keep routing.
+    """
+    if np.isinf(bound):
+        return True
+    return len(totals) >= limit and \
+        round(bound, 2) > round(np.partition(totals, limit - 1)[limit - 1], 2)
+
+
+def _route_columns(routes):
+    """ Distances and durations of routes as float arrays, NaN for missing routes """
+    values = np.array([route[:2] for route in routes], dtype=float).reshape(-1, 2)
+    return values[:, 0], values[:, 1]
+
+
+def _format_column(values, template='{}'):
+    return [template.format(int(value)) if np.isfinite(value) else None
+            for value in np.round(values)]
+
+
+def _last(iterable):
+    item = None
+    for item in iterable:
+        pass
+    return item
 
 
-def _project(element):
-    return transform(PROJECTION, element)
+def _route_query(row):
+    lat = row["lat"]
+    lon = row["lon"]
+    return f"{lat},{lon}" if lat and lon else f'{row["Name"]} Helsinki'
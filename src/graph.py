@@ -0,0 +1,296 @@
+import heapq
+from threading import Lock
+
+import numpy as np
+
+from .route import Router, _group_for_matrix
+from .settings import ROAD_GRAPH
+from .spatial import StationIndex, haversine, parse_coordinates, project
+
+
+SNAP_DISTANCE = 2000  # Metres from the nearest node a location can be routed from
+
+SNAP_SPEED = 30  # Km/h, between a location and its nearest node
+
+DEFAULT_SPEED = 50  # Km/h, of roads without maxspeed
+
+_graphs = {}
+
+_graphs_lock = Lock()
+
+
+class RoadGraph(object):
+    """
+    Directed road graph in compressed sparse row arrays. Edges leaving node i
+    are positions indptr[i]:indptr[i + 1] of targets, length (metres) and
+    duration (seconds). Nodes have WGS84 coordinates lat and lon.
+    """
+    def __init__(self, lat, lon, indptr, targets, length, duration):
+        self.lat = np.asarray(lat, dtype=float)
+        self.lon = np.asarray(lon, dtype=float)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.targets = np.asarray(targets, dtype=np.int32)
+        self.length = np.asarray(length, dtype=np.float32)
+        self.duration = np.asarray(duration, dtype=np.float32)
+        # Searches walk edges one by one, which is faster over Python lists
+        self._edges = (self.indptr.tolist(), self.targets.tolist(),
+                       self.length.tolist(), self.duration.tolist())
+        self._index = None
+        self._reversed = None
+
+    def __len__(self):
+        return len(self.lat)
+
+    @classmethod
+    def from_edges(cls, lat, lon, sources, targets, length, duration):
+        """ Build graph from node coordinates and arrays of directed edges """
+        sources = np.asarray(sources, dtype=np.int64)
+        order = np.argsort(sources, kind="stable")
+        indptr = np.zeros(len(lat) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(lat)), out=indptr[1:])
+        return cls(lat, lon, indptr, np.asarray(targets)[order],
+                   np.asarray(length)[order], np.asarray(duration)[order])
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["lat"], data["lon"], data["indptr"], data["targets"],
+                       data["length"], data["duration"])
+
+    def save(self, path):
+        np.savez_compressed(path, lat=self.lat, lon=self.lon, indptr=self.indptr,
+                            targets=self.targets, length=self.length,
+                            duration=self.duration)
+
+    def reversed(self):
+        """ Graph with every edge turned around, for searches towards a node """
+        if self._reversed is None:
+            sources = np.repeat(np.arange(len(self)), np.diff(self.indptr))
+            self._reversed = RoadGraph.from_edges(
+                self.lat, self.lon, self.targets, sources, self.length, self.duration
+            )
+        return self._reversed
+
+    def nearest(self, lat, lon, radius=SNAP_DISTANCE):
+        """ Return nearest node and its distance in metres, None if beyond radius """
+        if self._index is None:
+            self._index = StationIndex(np.arange(len(self)), *project(self.lat, self.lon),
+                                       radius)
+        x, y = project(lat, lon)
+        nodes = self._index.within_distance(x, y, radius).astype(int)
+        if not len(nodes):
+            return None, None
+        distances = np.hypot(self._index.x[nodes] - x, self._index.y[nodes] - y)
+        return int(nodes[np.argmin(distances)]), float(distances.min())
+
+    def search(self, source, targets):
+        """
+        Dijkstra by duration from source until all targets are settled.
+        Returns dicts of duration, length and previous node by settled node.
+        """
+        indptr, edge_targets, edge_length, edge_duration = self._edges
+        duration, length, previous = {source: 0.0}, {source: 0.0}, {source: None}
+        remaining = set(targets)
+        settled = set()
+        queue = [(0.0, source)]
+        while queue and remaining:
+            current, node = heapq.heappop(queue)
+            if node in settled:
+                continue
+            settled.add(node)
+            remaining.discard(node)
+            for edge in range(indptr[node], indptr[node + 1]):
+                target = edge_targets[edge]
+                candidate = current + edge_duration[edge]
+                if target not in settled and candidate < duration.get(target, np.inf):
+                    duration[target] = candidate
+                    length[target] = length[node] + edge_length[edge]
+                    previous[target] = node
+                    heapq.heappush(queue, (candidate, target))
+        return ({node: duration[node] for node in settled},
+                {node: length[node] for node in settled}, previous)
+
+    def path(self, previous, node):
+        """ Nodes from the search source to node, following previous nodes """
+        nodes = []
+        while node is not None:
+            nodes.append(node)
+            node = previous[node]
+        return nodes[::-1]
+
+
+def load_graph(path=ROAD_GRAPH):
+    """ Road graph from npz file, loaded once per process """
+    if not path:
+        raise ValueError("ROAD_GRAPH must point to a road graph file for local routing")
+    with _graphs_lock:
+        if path not in _graphs:
+            _graphs[path] = RoadGraph.load(path)
+        return _graphs[path]
+
+
+def graph_from_geojson(data, default_speed=DEFAULT_SPEED):
+    """
+    Build road graph from GeoJSON feature collection of LineString or
+    MultiLineString roads, as exported from OpenStreetMap. Lines sharing a
+    vertex are connected there. Properties maxspeed (km/h) and oneway ("yes"
+    or true) are used when present.
+    """
+    nodes, sources, targets, speeds = {}, [], [], []
+    for feature in data["features"]:
+        geometry = feature.get("geometry") or {}
+        lines = geometry.get("coordinates", [])
+        if geometry.get("type") == "LineString":
+            lines = [lines]
+        elif geometry.get("type") != "MultiLineString":
+            continue
+        properties = feature.get("properties") or {}
+        speed = _speed(properties.get("maxspeed"), default_speed)
+        oneway = properties.get("oneway") in (True, "yes", "true", "1")
+        for line in lines:
+            vertices = [nodes.setdefault((round(lat, 7), round(lon, 7)), len(nodes))
+                        for lon, lat, *_ in line]
+            for start, end in zip(vertices, vertices[1:]):
+                sources.append(start)
+                targets.append(end)
+                speeds.append(speed)
+                if not oneway:
+                    sources.append(end)
+                    targets.append(start)
+                    speeds.append(speed)
+    coordinates = np.array(list(nodes), dtype=float).reshape(-1, 2)
+    lat, lon = coordinates[:, 0], coordinates[:, 1]
+    sources, targets = np.array(sources, dtype=int), np.array(targets, dtype=int)
+    length = haversine(lat[sources], lon[sources], lat[targets], lon[targets])
+    return RoadGraph.from_edges(lat, lon, sources, targets, length,
+                                length / (np.array(speeds) / 3.6))
+
+
+def _speed(maxspeed, default_speed):
+    try:
+        return float(str(maxspeed).split()[0])
+    except (TypeError, ValueError, IndexError):
+        return default_speed
+
+
+class LocalRouter(object):
+    """
+    Router answering routes from a road graph on disk instead of Bing Maps,
+    with the same methods as Router. Pairs sharing a start are answered by one
+    search from the start and pairs sharing an end by one search towards the
+    end, over reversed edges. Locations are snapped to their nearest node and
+    the rest of the way is straight at SNAP_SPEED. Addresses are still
+    geocoded by geocoder, Bing by default, and count as its requests. Routes
+    are not cached, so switching routers never mixes their results.
+    """
+    matrix = True  # Pairs are answered by group, like distance matrix requests
+
+    def __init__(self, graph=None, geocoder=None):
+        self.graph = graph if graph is not None else load_graph()
+        self.geocoder = geocoder if geocoder is not None else Router()
+        self.concurrency = self.geocoder.concurrency
+
+    @property
+    def count(self):
+        return self.geocoder.count
+
+    @property
+    def budget(self):
+        return self.geocoder.budget
+
+    @property
+    def budget_limit(self):
+        return self.geocoder.budget_limit
+
+    @property
+    def exhausted(self):
+        return self.geocoder.exhausted
+
+    def reset_budget(self, limit=None):
+        return self.geocoder.reset_budget(limit)
+
+    def get_point(self, address, cache=None):
+        return parse_coordinates(address) or self.geocoder.get_point(address, cache)
+
+    def get_route(self, start, end, cache, tolerance=0):
+        """
+        Return distance (km) and duration (min) and collection of coordinates as
+        route path from start location to end location
+        """
+        return self.get_routes([(start, end)], cache, tolerance)[0]
+
+    def get_routes(self, pairs, cache, tolerance=0):
+        """ Return routes with path for list of (start, end) pairs, in their order """
+        return self._route_pairs(pairs, cache, paths=True)
+
+    def get_distances(self, pairs, cache):
+        """ Return routes without path for list of (start, end) pairs """
+        return self._route_pairs(pairs, cache, paths=False)
+
+    def _route_pairs(self, pairs, cache, paths):
+        unique = list(dict.fromkeys(pairs))
+        snapped = {location: self._snap(location, cache)
+                   for location in {location for pair in unique for location in pair}}
+        routes = {pair: (None, None, None) for pair in unique}
+        for origins, destinations in _group_for_matrix(unique):
+            if len(origins) == 1:
+                routes.update(self._search(origins[0], destinations, snapped, paths))
+            else:
+                routes.update(self._search_to(origins, destinations[0], snapped,
+                                              paths))
+        return [routes[pair] for pair in pairs]
+
+    def _snap(self, location, cache):
+        lat, lon = self.get_point(location, cache) or (None, None)
+        if lat is None or lon is None:
+            return None
+        node, distance = self.graph.nearest(lat, lon)
+        return (node, distance, [lat, lon]) if node is not None else None
+
+    def _search(self, origin, destinations, snapped, paths):
+        """ Routes from origin to each destination from one search """
+        if snapped[origin] is None:
+            return {}
+        source = snapped[origin][0]
+        ends = {destination: snapped[destination] for destination in destinations
+                if snapped[destination] is not None}
+        duration, length, previous = self.graph.search(
+            source, [end[0] for end in ends.values()]
+        )
+        return {
+            (origin, destination): self._route(
+                snapped[origin], end, duration, length,
+                self.graph.path(previous, end[0]) if paths else None
+            )
+            for destination, end in ends.items() if end[0] in duration
+        }
+
+    def _search_to(self, origins, destination, snapped, paths):
+        """ Routes from each origin to destination from one reversed search """
+        if snapped[destination] is None:
+            return {}
+        starts = {origin: snapped[origin] for origin in origins
+                  if snapped[origin] is not None}
+        duration, length, previous = self.graph.reversed().search(
+            snapped[destination][0], [start[0] for start in starts.values()]
+        )
+        return {
+            (origin, destination): self._route(
+                start, snapped[destination], duration, length,
+                self.graph.path(previous, start[0])[::-1] if paths else None,
+                node=start[0]
+            )
+            for origin, start in starts.items() if start[0] in duration
+        }
+
+    def _route(self, start, end, duration, length, nodes, node=None):
+        """ Distance (km), duration (min) and path between snapped locations """
+        node = end[0] if node is None else node
+        snap = start[1] + end[1]
+        distance = (length[node] + snap) / 1000
+        minutes = (duration[node] + snap / (SNAP_SPEED / 3.6)) / 60
+        if nodes is None:
+            return distance, minutes, None
+        path = [start[2]] + [[float(self.graph.lat[n]), float(self.graph.lon[n])]
+                             for n in nodes] + [end[2]]
+        return distance, minutes, path
@@ -0,0 +1,222 @@
+import json
+import os
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from threading import Lock
+
+import numpy as np
+import pandas as pd
+
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .cache import get_data_folder_path
+from .providers import FUELS, price_column
+from .spatial import project
+
+
+HISTORY_FOLDER = 'history'
+
+COLUMNS = {
+    "station": np.int32,
+    "fuel": np.uint8,
+    "price": np.float32,
+    "recorded": np.int64,  # Seconds, when price was reported
+    "scraped": np.int64,  # Seconds, when price was fetched
+}
+
+HOURS_OF_WEEK = 7 * 24
+
+
+@contextmanager
+def _locked(path):
+    """ Hold an exclusive lock of file at path, shared by all processes """
+    with open(path, 'a') as file:
+        if fcntl is not None:
+            fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def _seconds(timestamps):
+    timestamps = pd.to_datetime(pd.Series(timestamps, dtype=object))
+    return timestamps.to_numpy('datetime64[s]').astype(np.int64)
+
+
+class PriceHistory(object):
+    """
+    Append only price history stored as one binary file per column, partitioned
+    by day of scrape. Queries memory map only the partitions in the requested
+    time range and process them one at a time, so the whole history is never
+    loaded into memory at once. Station ids are stored as integer codes, mapped
+    in ids.json. Appends hold a file lock, so processes sharing the history,
+    like server workers and the CLI, assign codes and write rows in turn.
+    """
+    def __init__(self, path=None):
+        self.path = path or f'{get_data_folder_path()}/{HISTORY_FOLDER}'
+        self._lock = Lock()
+        self.ids = self._read_ids()
+
+    def _read_ids(self):
+        try:
+            with open(f'{self.path}/ids.json', mode='r') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+
+    def _write_ids(self):
+        # Replaced whole, so readers never see a partly written mapping
+        with open(f'{self.path}/ids.json.tmp', 'w+') as outfile:
+            json.dump(self.ids, outfile)
+        os.replace(f'{self.path}/ids.json.tmp', f'{self.path}/ids.json')
+
+    def _reload_ids(self):
+        """ Read ids again, with stations other processes added since """
+        with self._lock:
+            self.ids = self._read_ids()
+            return self.ids
+
+    def _codes(self, ids, create=False):
+        codes = []
+        for id in ids:
+            if id not in self.ids and create:
+                self.ids[id] = len(self.ids)
+            codes.append(self.ids.get(id, -1))
+        return np.array(codes, dtype=COLUMNS["station"])
+
+    def append(self, stations, scraped=None):
+        """
+        Append prices of stations scraped at given time, now by default. Stations
+        is a DataFrame indexed by station id with Timestamp and <fuel> Price
+        columns.
+        """
+        scraped = scraped or datetime.now()
+        columns = {name: [] for name in COLUMNS}
+        partition = f'{self.path}/{scraped.date().isoformat()}'
+        os.makedirs(partition, exist_ok=True)
+        with self._lock, _locked(f'{self.path}/.lock'):
+            # Other processes may have added stations since ids were read
+            self.ids = self._read_ids()
+            codes = self._codes([str(id) for id in stations.index], create=True)
+            self._write_ids()
+            recorded = _seconds(stations["Timestamp"]) if len(stations) else []
+            for code, fuel in enumerate(FUELS):
+                column = price_column(fuel)
+                if column not in stations.columns:
+                    continue
+                prices = stations[column].to_numpy(dtype=float)
+                valid = ~np.isnan(prices)
+                columns["station"].append(codes[valid])
+                columns["fuel"].append(np.full(valid.sum(), code))
+                columns["price"].append(prices[valid])
+                columns["recorded"].append(np.asarray(recorded)[valid])
+                columns["scraped"].append(
+                    np.full(valid.sum(), _seconds([scraped])[0])
+                )
+            for name, dtype in COLUMNS.items():
+                values = np.concatenate(columns[name]) if columns[name] else []
+                with open(f'{partition}/{name}.bin', 'ab') as file:
+                    file.write(np.asarray(values, dtype=dtype).tobytes())
+
+    def _partitions(self, start=None, end=None):
+        if not os.path.exists(self.path):
+            return
+        for name in sorted(os.listdir(self.path)):
+            if not os.path.isdir(f'{self.path}/{name}'):
+                continue
+            day = datetime.fromisoformat(name)
+            if start and day + timedelta(days=1) <= start or end and day > end:
+                continue
+            yield f'{self.path}/{name}'
+
+    def _read(self, station_ids=None, start=None, end=None, fuel='95E10'):
+        """ Yield column arrays of each partition, filtered by the query """
+        codes = self._codes(station_ids) if station_ids is not None else None
+        for partition in self._partitions(start, end):
+            columns = {}
+            for name, dtype in COLUMNS.items():
+                path = f'{partition}/{name}.bin'
+                columns[name] = np.memmap(path, dtype=dtype, mode='r') \
+                    if os.path.getsize(path) else np.array([], dtype=dtype)
+            # Columns of an interrupted append may differ in length
+            rows = min(len(column) for column in columns.values())
+            mask = columns["fuel"][:rows] == FUELS.index(fuel)
+            if codes is not None:
+                mask &= np.isin(columns["station"][:rows], codes)
+            if start:
+                mask &= columns["scraped"][:rows] >= _seconds([start])[0]
+            if end:
+                mask &= columns["scraped"][:rows] <= _seconds([end])[0]
+            yield {
+                name: np.array(column[:rows][mask]) for name, column in columns.items()
+            }
+
+    def series(self, station_ids=None, start=None, end=None, fuel='95E10'):
+        """
+        Return price series of given stations, all by default, scraped between
+        start and end as DataFrame with station, scraped, recorded and price
+        columns.
+        """
+        partitions = list(self._read(station_ids, start, end, fuel))
+        # Read after the rows, so codes of rows appended meanwhile are mapped
+        ids = np.array(list(self._reload_ids()), dtype=object)
+        frames = [pd.DataFrame({
+            "station": ids[columns["station"]] if len(ids) else [],
+            "scraped": pd.to_datetime(columns["scraped"], unit='s'),
+            "recorded": pd.to_datetime(columns["recorded"], unit='s'),
+            "price": columns["price"].astype(float),
+        }) for columns in partitions]
+        if not frames:
+            return pd.DataFrame(columns=["station", "scraped", "recorded", "price"])
+        return pd.concat(frames, ignore_index=True)
+
+    def area_series(self, index, lat, lon, radius, **kwargs):
+        """ Price series of stations within radius metres from lat, lon """
+        ids = index.within_distance(*project(lat, lon), radius)
+        return self.series([str(id) for id in ids], **kwargs)
+
+    def cheapest_by_hour_of_week(self, station_ids=None, start=None, end=None,
+                                 fuel='95E10'):
+        """
+        Return lowest price seen for each hour of week, Monday 00 being hour 0, with
+        the station having it and mean price of the hour. Partitions are reduced
+        one at a time.
+        """
+        cheapest = np.full(HOURS_OF_WEEK, np.inf)
+        stations = np.full(HOURS_OF_WEEK, -1, dtype=np.int64)
+        totals = np.zeros(HOURS_OF_WEEK)
+        counts = np.zeros(HOURS_OF_WEEK, dtype=np.int64)
+        for columns in self._read(station_ids, start, end, fuel):
+            scraped = columns["scraped"].astype('datetime64[s]')
+            days = scraped.astype('datetime64[D]')
+            # 1970-01-01 was a Thursday, day 3 counting from Monday
+            weekday = (days.astype(np.int64) + 3) % 7
+            hour = (scraped - days).astype('timedelta64[h]').astype(np.int64)
+            buckets = weekday * 24 + hour
+            prices = columns["price"].astype(float)
+            np.add.at(totals, buckets, prices)
+            np.add.at(counts, buckets, 1)
+            order = np.lexsort((prices, buckets))
+            first = np.unique(buckets[order], return_index=True)[1]
+            best = order[first]
+            improved = prices[best] < cheapest[buckets[best]]
+            cheapest[buckets[best][improved]] = prices[best][improved]
+            stations[buckets[best][improved]] = columns["station"][best][improved]
+
+        ids = np.array(list(self._reload_ids()) + [None], dtype=object)
+        with np.errstate(invalid='ignore'):
+            mean = totals / counts
+        return pd.DataFrame({
+            "weekday": np.arange(HOURS_OF_WEEK) // 24,
+            "hour": np.arange(HOURS_OF_WEEK) % 24,
+            "cheapest": np.where(counts > 0, cheapest, np.nan),
+            "station": ids[stations],
+            "mean": mean,
+            "samples": counts,
+        })
@@ -0,0 +1,140 @@
+import time
+from contextlib import contextmanager
+from threading import Lock
+
+
+PREFIX = "gasoline"
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # Seconds
+
+STAGES = ("scrape", "parse", "geocode", "routing", "filtering", "pricing", "ranking",
+          "query")
+
+COUNTERS = {
+    "api_requests": ("endpoint", "Requests made to external services"),
+    "api_retries": ("endpoint", "Requests retried after throttling or server errors"),
+    "route_cache_lookups": ("result", "Route cache lookups by result"),
+}
+
+GAUGES = {
+    "route_cache_entries": "Entries in the route cache when last counted",
+}
+
+
+class Histogram(object):
+    """ Cumulative histogram of observed values with fixed bucket bounds """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics(object):
+    """
+    Process wide metrics: time spent in pipeline stages, requests to external
+    services by endpoint and route cache lookups. Stages may contain others, for
+    example routing includes geocoding the addresses routed between.
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}
+            self.counters = {name: {} for name in COUNTERS}
+            self.gauges = {}
+
+    @contextmanager
+    def timer(self, stage):
+        """ Time the block as one observation of stage """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def increment(self, counter, label, amount=1):
+        with self._lock:
+            values = self.counters[counter]
+            values[label] = values.get(label, 0) + amount
+
+    def set_gauge(self, gauge, value):
+        with self._lock:
+            self.gauges[gauge] = value
+
+    def summary(self):
+        """ Return dict of stage timings, counters and gauges """
+        with self._lock:
+            return {
+                "stages": {stage: {"count": self.stages[stage].count,
+                                   "seconds": self.stages[stage].sum}
+                           for stage in sorted(self.stages, key=_stage_order)},
+                "counters": {name: dict(values)
+                             for name, values in self.counters.items()},
+                "gauges": dict(self.gauges),
+            }
+
+    def render(self):
+        """ Return metrics in Prometheus text exposition format """
+        lines = [
+            f"# HELP {PREFIX}_stage_seconds Time spent in pipeline stages",
+            f"# TYPE {PREFIX}_stage_seconds histogram",
+        ]
+        with self._lock:
+            for stage in sorted(self.stages, key=_stage_order):
+                lines.extend(_histogram_lines(
+                    f"{PREFIX}_stage_seconds", f'stage="{stage}"', self.stages[stage]
+                ))
+            for name, (label, description) in COUNTERS.items():
+                lines.append(f"# HELP {PREFIX}_{name}_total {description}")
+                lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+                for value, count in sorted(self.counters[name].items()):
+                    lines.append(
+                        f'{PREFIX}_{name}_total{{{label}="{_escape(value)}"}} {count}'
+                    )
+            for name, description in GAUGES.items():
+                if name not in self.gauges:
+                    continue
+                lines.append(f"# HELP {PREFIX}_{name} {description}")
+                lines.append(f"# TYPE {PREFIX}_{name} gauge")
+                lines.append(f"{PREFIX}_{name} {self.gauges[name]}")
+        return "\n".join(lines) + "\n"
+
+
+def _stage_order(stage):
+    return (STAGES.index(stage), stage) if stage in STAGES else (len(STAGES), stage)
+
+
+def _histogram_lines(name, labels, histogram):
+    lines = [
+        f'{name}_bucket{{{labels},le="{bound}"}} {count}'
+        for bound, count in zip(histogram.buckets, histogram.counts)
+    ]
+    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+    lines.append(f'{name}_sum{{{labels}}} {histogram.sum}')
+    lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+    return lines
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+METRICS = Metrics()
@@ -1,3 +1,4 @@
+import hashlib
 import json
 import urllib.parse as urlparse
 from datetime import datetime
@@ -5,14 +6,26 @@ from urllib.parse import parse_qs
 
 import pandas as pd
 import requests
-from bs4 import BeautifulSoup
+
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
 
 from .cache import Cache
+from .history import PriceHistory
+from .metrics import METRICS
+from .providers import FUELS, Provider, price_column
+from .settings import POLTTOAINE_URL, PRICE_HISTORY
+from .spatial import StationIndex
 
 
-URL = "https://www.polttoaine.net/index.php?cmd=haku&act=hae"
+URL = f"{POLTTOAINE_URL}/index.php?cmd=haku&act=hae"
 DATA = "'nimi%5B%5D=520&nimi%5B%5D=2&nimi%5B%5D=5&nimi%5B%5D=11&nimi%5B%5D=18&nimi%5B%5D=19&nimi%5B%5D=20&nimi%5B%5D=23&nimi%5B%5D=29&nimi%5B%5D=31&nimi%5B%5D=32&nimi%5B%5D=39&nimi%5B%5D=41&nimi%5B%5D=44&nimi%5B%5D=47&nimi%5B%5D=49&nimi%5B%5D=52&nimi%5B%5D=53&nimi%5B%5D=58&nimi%5B%5D=59&nimi%5B%5D=66&nimi%5B%5D=68&nimi%5B%5D=69&nimi%5B%5D=77&nimi%5B%5D=78&nimi%5B%5D=84&nimi%5B%5D=85&nimi%5B%5D=88&nimi%5B%5D=90&nimi%5B%5D=92&nimi%5B%5D=99&nimi%5B%5D=104&nimi%5B%5D=105&nimi%5B%5D=106&nimi%5B%5D=107&nimi%5B%5D=113&nimi%5B%5D=124&nimi%5B%5D=125&nimi%5B%5D=130&nimi%5B%5D=136&nimi%5B%5D=142&nimi%5B%5D=143&nimi%5B%5D=144&nimi%5B%5D=149&nimi%5B%5D=160&nimi%5B%5D=161&nimi%5B%5D=162&nimi%5B%5D=163&nimi%5B%5D=168&nimi%5B%5D=171&nimi%5B%5D=177&nimi%5B%5D=184&nimi%5B%5D=185&nimi%5B%5D=186&nimi%5B%5D=188&nimi%5B%5D=195&nimi%5B%5D=527&nimi%5B%5D=221&nimi%5B%5D=222&nimi%5B%5D=227&nimi%5B%5D=228&nimi%5B%5D=229&nimi%5B%5D=233&nimi%5B%5D=238&nimi%5B%5D=240&nimi%5B%5D=241&nimi%5B%5D=245&nimi%5B%5D=250&nimi%5B%5D=252&nimi%5B%5D=263&nimi%5B%5D=264&nimi%5B%5D=267&nimi%5B%5D=271&nimi%5B%5D=273&nimi%5B%5D=283&nimi%5B%5D=284&nimi%5B%5D=289&nimi%5B%5D=291&nimi%5B%5D=528&nimi%5B%5D=292&nimi%5B%5D=293&nimi%5B%5D=296&nimi%5B%5D=302&nimi%5B%5D=306&nimi%5B%5D=318&nimi%5B%5D=530&nimi%5B%5D=329&nimi%5B%5D=333&nimi%5B%5D=338&nimi%5B%5D=354&nimi%5B%5D=365&nimi%5B%5D=369&nimi%5B%5D=374&nimi%5B%5D=381&nimi%5B%5D=385&nimi%5B%5D=197&nimi%5B%5D=388&nimi%5B%5D=398&nimi%5B%5D=416&nimi%5B%5D=419&nimi%5B%5D=420&nimi%5B%5D=423&haku=Hae+asemat'"  # noqa: E501
 
+FUEL_POSITIONS = {fuel: position for position, fuel in enumerate(FUELS)}
+
 HEADER = {
     "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like " +
                   "Gecko) Chrome/50.0.2661.75 Safari/537.36",
@@ -21,15 +34,102 @@ HEADER = {
 }
 
 
-class PolttoaineNet(object):
-    def __init__(self):
+class PolttoaineNet(Provider):
+    name = "polttoaine.net"
+
+    def __init__(self, station_locations=None, record_history=PRICE_HISTORY):
+        """
+        Station locations, by id with name, lat and lon, are fetched from
+        polttoaine.net, or the cache of an earlier fetch, when not given.
+        """
         self.stations_cache = Cache('polttoaine_net', 'stations.json')
-        self.station_locations = self._fetch_station_locations()
+        self.station_locations = station_locations if station_locations is not None \
+            else self._fetch_station_locations()
+        self._index = None
+        self.stations = None
+        self._validators = {}
+        self._content_hash = None
+        self._row_ids = {}
+        self.history = PriceHistory() if record_history else None
+
+    @property
+    def index(self):
+        """ Spatial index over station locations, built once per instance """
+        if self._index is None:
+            self._index = StationIndex.from_locations(self.station_locations)
+        return self._index
 
     def fetch_stations(self):
-        table = self._fetch_table()
-        parsed = self._parse_table(table)
-        return parsed
+        self.fetch_changes()
+        return self.stations
+
+    def fetch_changes(self):
+        """
+        Fetch price table and update self.stations from the rows changed since the
+        previous fetch. Unchanged responses are detected from conditional request
+        headers or content hash. Otherwise the table is parsed once and unchanged
+        rows are detected from the hash of their cells, so only new and changed
+        rows are turned into stations.
+
+        Returns:
+            Tuple of DataFrame of new and changed stations and list of ids of
+            stations no longer listed, both empty when nothing changed
+        """
+        html = self._fetch_html()
+        content_hash = _hash(html) if html is not None else self._content_hash
+        if self.stations is not None and content_hash == self._content_hash:
+            self._record_history()
+            return self.stations.iloc[:0], []
+
+        with METRICS.timer("parse"):
+            row_ids, order, parsed = self._parse_changed_rows(html)
+            changed = self._stations_frame(parsed)
+        self._content_hash = content_hash
+        listed = set(order)
+        invalid = {station[0] for station in parsed} - set(changed.index)
+        previous = self.stations.index if self.stations is not None else []
+        removed = [id for id in previous if id not in listed or id in invalid]
+        self._row_ids = row_ids
+        self.stations = self._apply_changes(changed, removed, order)
+        self._record_history()
+        return changed, removed
+
+    def _parse_changed_rows(self, html):
+        """
+        Parse stations from table rows not seen in the previous fetch
+
+        Returns:
+            Tuple of dict of row hash to station id, list of station ids in table
+            order and list of parsed stations
+        """
+        now = datetime.now()
+        row_ids = {}
+        order = []
+        parsed = []
+        for cells in _table_rows(html):
+            row_hash = _hash(repr(cells))
+            if row_hash not in self._row_ids and row_hash not in row_ids:
+                station = self._parse_row(cells, now)
+                row_ids[row_hash] = station[0] if station else None
+                if station:
+                    parsed.append(station)
+            else:
+                row_ids[row_hash] = self._row_ids.get(row_hash, row_ids.get(row_hash))
+            order.append(row_ids[row_hash])
+        return row_ids, order, parsed
+
+    def _record_history(self):
+        if self.history is not None:
+            self.history.append(self.stations)
+
+    def _apply_changes(self, changed, removed, order):
+        stations = changed if self.stations is None else pd.concat([
+            self.stations.drop(index=[*removed, *changed.index], errors='ignore'),
+            changed
+        ])
+        stations = stations[~stations.index.duplicated(keep='last')]
+        listed = pd.Index([id for id in order if id]).drop_duplicates()
+        return stations.reindex(listed.intersection(stations.index, sort=False))
 
     def __repr__(self):
         return 'Polttoaine.net'
@@ -37,122 +137,193 @@ class PolttoaineNet(object):
     def __str__(self):
         return self.__repr__()
 
-    def _fetch_table(self):
-        resp = requests.post(URL, headers=HEADER, data=DATA)
-        soup = BeautifulSoup(resp.text, 'html.parser')
-        return soup.find(id="Hinnat").find("table").find_all("tr")
+    def _fetch_html(self):
+        """ Fetch price table page, None if not modified since previous fetch """
+        with METRICS.timer("scrape"):
+            resp = requests.post(URL, headers={**HEADER, **self._validators}, data=DATA)
+        METRICS.increment("api_requests", "polttoaine.net")
+        if resp.status_code == 304:
+            return None
+        resp.raise_for_status()
+        self._validators = {}
+        if resp.headers.get("ETag"):
+            self._validators["If-None-Match"] = resp.headers["ETag"]
+        if resp.headers.get("Last-Modified"):
+            self._validators["If-Modified-Since"] = resp.headers["Last-Modified"]
+        return resp.text
 
     def _parse_table(self, table):
         """
-        Parse stations and gas price from table parsed by beatifulsoup
+        Parse stations and gas price from table rows, filling the columns directly
 
         Args:
-            table: A table element parsed by beatifulsoup
+            table: Rows as lists of cells, see _table_rows
         Returns:
             DataFrame containing station details and gas price
         """
-        index = []
-        data = []
-        for row in table:
-            station = self._parse_station_details(row)
-            if not station.get("id"):
-                continue
-            price = self._parse_gas_price(row)
-            timestamp = self._parse_timestamp(row)
-            index.append(station.get("id"))
-            name = station.get("name")
-            data.append([name, price, timestamp, station.get('lat'), station.get('lon')])
-        return pd.DataFrame(data, index=index, columns=[
-            'Name', '95E10 Price', 'Timestamp', 'lat', 'lon'
-        ]) \
-            .dropna(subset=['95E10 Price', 'lat', 'lon']) \
-            .astype({"95E10 Price": float, "lat": float, "lon": float})
-
-    def _parse_station_details(self, row):
-        """
-        Parse station name and id from table cell.
-
-        Args:
-            table_cell: A td element parsed by beatifulsoup
-        Returns:
+        now = datetime.now()
+        return self._stations_frame(
+            station for station in (self._parse_row(cells, now) for cells in table)
+            if station
+        )
 
+    def _stations_frame(self, stations):
         """
-        for cell in row.find_all("td"):
-            anchor = cell.find("a")
-            if not anchor or len(cell.contents) < 2:
-                return {}
-
-            url = anchor["href"]
-            parsed = parse_qs(urlparse.urlparse(url).query)
-            id = parsed.get("id")
-            id = id[0] if id else None
-            output = {
-                "id": id,
-                "name": cell.contents[2]
-            }
-            if id and id in self.station_locations:
-                station = self.station_locations.get(id)
-                output.update({
-                    "name": station.get("name"),
-                    "lat": station.get("lat"),
-                    "lon": station.get("lon"),
-                })
-            return output
-        return {}
-
-    def _parse_gas_price(self, row):
-        """
-        Parse 95E10 gas price from table row.
+        Build DataFrame from parsed stations, filling the columns directly
 
         Args:
-            table_row: A tr element parsed by beatifulsoup
+            stations: Iterable of id, name, prices and timestamp tuples, with
+                prices in the order of FUELS
         Returns:
-            (String) Gas price
+            DataFrame containing station details and a price column per fuel
         """
-        for cell in row.find_all("td"):
-            title = cell.get("title")
-            if title == "95E10":
-                try:
-                    return float(cell.contents[0])
-                except ValueError:
-                    return None
-        return None
+        index, names, timestamps, lats, lons = [], [], [], [], []
+        prices = [[] for _ in FUELS]
+        for id, name, station_prices, timestamp in stations:
+            location = self.station_locations.get(id, {})
+            index.append(id)
+            names.append(location.get("name", name))
+            for column, price in zip(prices, station_prices):
+                column.append(price)
+            timestamps.append(timestamp)
+            lats.append(location.get("lat"))
+            lons.append(location.get("lon"))
+        price_columns = [price_column(fuel) for fuel in FUELS]
+        return pd.DataFrame({
+            'Name': names,
+            **dict(zip(price_columns, prices)),
+            'Timestamp': timestamps,
+            'lat': lats,
+            'lon': lons,
+        }, index=index) \
+            .dropna(subset=price_columns, how='all') \
+            .dropna(subset=['lat', 'lon']) \
+            .astype({**{column: float for column in price_columns},
+                     "Timestamp": "datetime64[ns]", "lat": float, "lon": float})
 
-    def _parse_timestamp(self, row):
+    def _parse_row(self, cells, now):
         """
-        Parse timestamp for gasoline prices from table row.
+        Parse station id and name, prices of all fuels and price timestamp from a
+        table row in a single pass over its cells.
+
         Args:
-            table_row: A tr element parsed by beatifulsoup
+            cells: List of (attributes, contents, anchor href) tuples of td elements
+            now: Datetime used as base of the timestamp
         Returns:
-            (Datetime) Timestamp
+            Tuple of id, name, list of prices in the order of FUELS and timestamp
+            or None if row is not a station
         """
-        cell = None
-        for cell in row.find_all("td"):
-            if not cell.attrs:
-                continue
-            if not set(cell.attrs.get("class")).isdisjoint(set(["Pvm", "PvmTd"])):
-                day, month = cell.contents[0][:-1].split(".")
-                return datetime.now().replace(month=int(month), day=int(day))
-        return None
+        if not cells:
+            return None
+        _, contents, href = cells[0]
+        if not href or len(contents) < 2:
+            return None
+        id = parse_qs(urlparse.urlparse(href).query).get("id")
+        if not id:
+            return None
+        name = contents[2] if len(contents) > 2 else None
+
+        prices = [None] * len(FUELS)
+        timestamp = None
+        timestamp_found = False
+        for attrs, contents, _ in cells:
+            fuel = FUEL_POSITIONS.get(attrs.get("title"))
+            if fuel is not None and prices[fuel] is None:
+                prices[fuel] = _parse_price(contents)
+            classes = attrs.get("class") or []
+            if not timestamp_found and not set(classes).isdisjoint({"Pvm", "PvmTd"}):
+                timestamp_found = True
+                day, month = contents[0][:-1].split(".")
+                timestamp = now.replace(month=int(month), day=int(day))
+        return id[0], name, prices, timestamp
 
     def _fetch_station_locations(self):
-        """ Fetch coordinates for stations """
+        """ Fetch coordinates for stations, raising RuntimeError if there are none """
         if self.stations_cache.cache:
             return self.stations_cache.cache
         headers = HEADER.copy()
-        headers["Referer"] = "https://www.polttoaine.net"
-        resp = requests.post('https://www.polttoaine.net/ajax.php', {
-            "act": "map",
-            "lat": 60.21,
-            "lon": 25.08
-        }, headers=headers)
+        headers["Referer"] = POLTTOAINE_URL
+        with METRICS.timer("scrape"):
+            resp = requests.post(f'{POLTTOAINE_URL}/ajax.php', {
+                "act": "map",
+                "lat": 60.21,
+                "lon": 25.08
+            }, headers=headers)
+        METRICS.increment("api_requests", "polttoaine.net")
         if resp.status_code != 200:
-            return {}
+            # Without locations no station could be ranked, fail so it is retried
+            raise RuntimeError(
+                f"Fetching station locations failed with status {resp.status_code}"
+            )
         stations = {station["id"]: {
             "name": station["nimi"],
             "lat": station["lat"],
             "lon": station["lon"]
         } for station in json.loads(resp.text)}
+        if not stations:
+            raise RuntimeError("Fetching station locations returned none")
         self.stations_cache.update(stations)
         self.stations_cache.write_cache()
         return stations
+
+
+def _hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _parse_price(contents):
+    try:
+        return float(contents[0])
+    except (IndexError, ValueError):
+        return None
+
+
+def _table_rows(html):
+    """
+    Return rows of the price table as lists of (attributes, contents, anchor href)
+    tuples of their td elements. Contents are the texts of the child nodes. Uses
+    lxml when installed and the pure Python parser of beautifulsoup otherwise.
+    """
+    return _lxml_rows(html) if lxml else _soup_rows(html)
+
+
+def _soup_rows(html):
+    # Imported only when needed, lxml is used instead when installed
+    from bs4 import BeautifulSoup
+    prices = BeautifulSoup(html, 'html.parser').find(id="Hinnat")
+    table = prices.find("table") if prices else None
+    if table is None:
+        raise ValueError("Price table not found")
+    for row in table.find_all("tr"):
+        cells = []
+        for cell in row.find_all("td"):
+            anchor = cell.find("a")
+            cells.append((
+                cell.attrs,
+                [str(node) if isinstance(node, str) else node.get_text()
+                 for node in cell.contents],
+                anchor.get("href") if anchor else None
+            ))
+        yield cells
+
+
+def _lxml_rows(html):
+    prices = lxml.html.fromstring(html).get_element_by_id("Hinnat", None)
+    table = prices.find(".//table") if prices is not None else None
+    if table is None:
+        raise ValueError("Price table not found")
+    for row in table.iter("tr"):
+        cells = []
+        for cell in row.iter("td"):
+            contents = [cell.text] if cell.text else []
+            for node in cell:
+                contents.append(node.text_content())
+                if node.tail:
+                    contents.append(node.tail)
+            attrs = dict(cell.attrib)
+            if "class" in attrs:
+                attrs["class"] = attrs["class"].split()
+            anchor = next(cell.iter("a"), None)
+            cells.append((attrs, contents, anchor.get("href") if anchor is not None
+                          else None))
+        yield cells
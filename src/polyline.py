@@ -0,0 +1,68 @@
+import numpy as np
+
+from .spatial import project
+
+
+PRECISION = 5  # Decimals kept, about one metre
+
+
+def encode(coordinates, precision=PRECISION):
+    """
+    Encode list of (lat, lon) coordinates to a string using the encoded polyline
+    algorithm format, storing each coordinate as a delta to the previous one.
+    """
+    if not len(coordinates):
+        return ''
+    values = np.round(np.asarray(coordinates, dtype=float) * 10 ** precision)
+    deltas = np.diff(values.astype(np.int64), axis=0, prepend=0).ravel()
+    output = []
+    for value in deltas.tolist():
+        value = ~(value << 1) if value < 0 else value << 1
+        while value >= 0x20:
+            output.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        output.append(chr(value + 63))
+    return ''.join(output)
+
+
+def decode(encoded, precision=PRECISION):
+    """ Decode string made by encode back to list of [lat, lon] coordinates """
+    chunks = np.frombuffer(encoded.encode('ascii'), dtype=np.uint8).astype(np.int64) - 63
+    if not len(chunks):
+        return []
+    ends = np.flatnonzero(chunks < 0x20)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    shifts = 5 * (np.arange(len(chunks)) - np.repeat(starts, ends - starts + 1))
+    values = np.add.reduceat((chunks & 0x1f) << shifts, starts)
+    values = (values >> 1) ^ -(values & 1)
+    coordinates = np.cumsum(values.reshape(-1, 2), axis=0)
+    return (coordinates / 10 ** precision).tolist()
+
+
+def simplify(coordinates, tolerance):
+    """
+    Simplify list of (lat, lon) coordinates with Douglas-Peucker algorithm so that
+    the result stays within tolerance metres of the original line.
+    """
+    if tolerance <= 0 or len(coordinates) < 3:
+        return coordinates
+    points = np.asarray(coordinates, dtype=float)
+    x, y = project(points[:, 0], points[:, 1])
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        px, py = x[first + 1:last] - x[first], y[first + 1:last] - y[first]
+        length = dx ** 2 + dy ** 2
+        t = np.clip((px * dx + py * dy) / length, 0, 1) if length else 0
+        distances = np.hypot(px - t * dx, py - t * dy)
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            middle = first + 1 + farthest
+            keep[middle] = True
+            stack.extend([(first, middle), (middle, last)])
+    return points[keep].tolist()
@@ -0,0 +1,263 @@
+import importlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from .cache import normalize_address
+from .settings import PROVIDERS
+from .spatial import StationIndex, project
+
+
+log = logging.getLogger("rich")
+
+DUPLICATE_DISTANCE = 30  # Metres within which stations are the same site
+
+DUPLICATE_NAME_DISTANCE = 1000  # Metres within which equally named ones are
+
+FUELS = ['95E10', '98E5', 'Diesel']  # Append only, price history stores positions
+
+DEFAULT_FUEL = '95E10'
+
+COLUMNS = ['Name', 'Timestamp', 'lat', 'lon']  # At least, with one <fuel> Price
+
+REGISTRY = {
+    "polttoaine_net": "src.parse.PolttoaineNet",
+}
+
+
+class Provider(object):
+    """
+    Source of station prices. Subclasses set name and implement fetch_stations,
+    returning DataFrame indexed by station id with COLUMNS and price column of
+    each fuel they know, see price_column.
+    Providers may also implement fetch_changes returning changed stations and
+    removed ids since the previous fetch.
+    """
+    name = None
+
+    def fetch_stations(self):
+        raise NotImplementedError
+
+    def __str__(self):
+        return self.name or type(self).__name__
+
+
+def price_column(fuel):
+    """ Name of column holding price per litre of fuel """
+    return f'{fuel} Price'
+
+
+def empty_stations(fuels=FUELS):
+    """ Stations DataFrame without rows, with the column types of a fetched one """
+    return pd.DataFrame({
+        "Name": pd.Series([], dtype=object),
+        **{price_column(fuel): pd.Series([], dtype=float) for fuel in fuels},
+        "Timestamp": pd.Series([], dtype="datetime64[ns]"),
+        "lat": pd.Series([], dtype=float),
+        "lon": pd.Series([], dtype=float),
+    })
+
+
+def register(name, provider):
+    """ Register provider class, or dotted path to it imported on first use """
+    REGISTRY[name] = provider
+
+
+def create_provider(name):
+    """ Construct registered provider by name """
+    provider = REGISTRY.get(name)
+    if provider is None:
+        raise ValueError(f"Unknown provider {name}, one of {', '.join(REGISTRY)}")
+    if isinstance(provider, str):
+        module, _, attribute = provider.rpartition('.')
+        provider = getattr(importlib.import_module(module), attribute)
+    return provider()
+
+
+def configured_provider(names=PROVIDERS):
+    """ Provider merging all providers named in comma separated names """
+    return MultiProvider([
+        create_provider(name.strip()) for name in names.split(',') if name.strip()
+    ])
+
+
+class MultiProvider(Provider):
+    """
+    Fetch stations from all providers concurrently and merge them into one
+    table. Station ids are prefixed with the provider name. Stations of
+    different providers at the same site are merged, keeping the freshest price.
+    Only the changes each provider reports are applied, see fetch_changes.
+    A provider failing to fetch keeps its previous stations in the table, and
+    the fetch fails when all of them do.
+    """
+    def __init__(self, providers):
+        self.providers = providers
+        self.stations = None
+        self._all = None
+        self._fetched = {}
+        self._index = None
+
+    def __str__(self):
+        return ", ".join(str(provider) for provider in self.providers)
+
+    @property
+    def index(self):
+        """
+        Spatial index over stations of all providers, duplicates included,
+        rebuilt only when stations are added or moved. Rankings look up the ids
+        it returns from their stations, so it may cover stations no longer listed.
+        """
+        if self._index is None:
+            self._index = StationIndex.from_stations(
+                self._all if self._all is not None else empty_stations()
+            )
+        return self._index
+
+    def fetch_stations(self):
+        self.fetch_changes()
+        return self.stations
+
+    def fetch_changes(self):
+        """
+        Fetch changes of all providers and merge them into stations. Providers
+        implementing fetch_changes report their own changes, the stations of
+        others are compared to their previous fetch.
+
+        Returns:
+            Tuple of DataFrame of new and changed stations and list of ids of
+            stations no longer listed, both empty when nothing changed
+        """
+        with ThreadPoolExecutor(max_workers=max(len(self.providers), 1)) as executor:
+            results = list(executor.map(self._fetch, self.providers))
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors and len(errors) == len(self.providers):
+            # Previous stations are kept, but not refreshed by anything
+            raise RuntimeError(f"Fetching stations from {self} failed") from errors[0]
+        changes = [(str(provider), result)
+                   for provider, result in zip(self.providers, results)
+                   if not isinstance(result, Exception)]
+        changed = pd.concat([_prefixed(name, stations)
+                             for name, (stations, _) in changes])
+        removed = [f'{name}:{id}' for name, (_, ids) in changes for id in ids]
+        return self._apply_changes(changed, removed)
+
+    def _fetch(self, provider):
+        """
+        Changed stations and removed ids of provider since its previous fetch,
+        or the error when fetching fails
+        """
+        try:
+            if hasattr(provider, "fetch_changes"):
+                return provider.fetch_changes()
+            stations = provider.fetch_stations()
+        except Exception as error:
+            log.exception(f"Fetching stations from {provider} failed")
+            return error
+        previous = self._fetched.get(provider)
+        self._fetched[provider] = stations
+        return (stations, []) if previous is None else _changes(previous, stations)
+
+    def _apply_changes(self, changed, removed):
+        """
+        Apply changes of providers to stations of all of them, and merge those
+        again. Returns changes of the merged stations, including ones that
+        became or stopped being a duplicate.
+        """
+        previous = self.stations
+        if self._all is None or _moved(self._all, changed):
+            self._index = None
+        self._all = changed if self._all is None else _updated(self._all, changed,
+                                                               removed)
+        self.stations = self._all[~_duplicates(self._all)] \
+            if len(self.providers) > 1 else self._all
+        if previous is None:
+            return self.stations, []
+        ids = self.stations.index
+        listed = ~ids.isin(previous.index) | ids.isin(changed.index)
+        return self.stations[listed], list(previous.index.difference(ids))
+
+
+def _prefixed(name, stations):
+    """ Stations with ids prefixed with provider name and a Provider column """
+    return stations.assign(Provider=name).set_axis(
+        [f'{name}:{id}' for id in stations.index], axis=0
+    )
+
+
+def _updated(stations, changed, removed):
+    """ Stations with changed ones replaced in place and new ones appended """
+    order = stations.index.drop(removed, errors='ignore').append(
+        changed.index.difference(stations.index, sort=False)
+    )
+    return pd.concat([
+        stations.drop(index=[*removed, *changed.index], errors='ignore'), changed
+    ]).reindex(order)
+
+
+def _moved(previous, changed):
+    """ Whether any of changed stations is new or at other coordinates than before """
+    before = previous.reindex(changed.index)[["lat", "lon"]].to_numpy(dtype=float)
+    after = changed[["lat", "lon"]].to_numpy(dtype=float)
+    return not np.allclose(before, after, equal_nan=True)
+
+
+def merge_stations(sources):
+    """
+    Merge list of (provider name, stations) into one DataFrame. Stations of
+    different providers within DUPLICATE_DISTANCE metres of each other, or with
+    the same name within DUPLICATE_NAME_DISTANCE metres, are the same site and
+    only the one with the freshest price is kept.
+    """
+    frames = [_prefixed(name, stations) for name, stations in sources]
+    if not frames:
+        return empty_stations().assign(Provider=pd.Series([], dtype=object))
+    merged = pd.concat(frames) if len(frames) > 1 else frames[0]
+    if len(frames) > 1:
+        merged = merged[~_duplicates(merged)]
+    return merged
+
+
+def _duplicates(stations):
+    """ Boolean mask of stations with a fresher duplicate from another provider """
+    lat = stations["lat"].to_numpy(dtype=float)
+    lon = stations["lon"].to_numpy(dtype=float)
+    located = ~(np.isnan(lat) | np.isnan(lon))
+    x, y = np.full(len(stations), np.nan), np.full(len(stations), np.nan)
+    if located.any():
+        x[located], y[located] = project(lat[located], lon[located])
+    names = [normalize_address(str(name)) for name in stations["Name"]]
+    providers = stations["Provider"].to_numpy()
+    positions = np.arange(len(stations))
+    index = StationIndex(positions[located], x[located], y[located],
+                         DUPLICATE_NAME_DISTANCE)
+    # Freshest first, ties keep the provider listed first
+    order = stations["Timestamp"].reset_index(drop=True).sort_values(
+        ascending=False, kind="stable", na_position="last"
+    ).index
+    duplicate = np.zeros(len(stations), dtype=bool)
+    for position in order:
+        if duplicate[position] or not located[position]:
+            continue
+        for other in index.within_distance(x[position], y[position],
+                                           DUPLICATE_NAME_DISTANCE):
+            if other == position or duplicate[other] or \
+                    providers[other] == providers[position]:
+                continue
+            near = np.hypot(x[other] - x[position], y[other] - y[position]) <= \
+                DUPLICATE_DISTANCE
+            if near or names[other] == names[position]:
+                duplicate[other] = True
+    return duplicate
+
+
+def _changes(previous, current):
+    """ Stations new or changed in current and ids of stations not in it """
+    common = current.index.intersection(previous.index)
+    before = previous.loc[common].reindex(columns=current.columns)
+    after = current.loc[common]
+    differs = ~((before == after) | (before.isna() & after.isna())).all(axis=1)
+    changed_ids = current.index.difference(previous.index).union(common[differs])
+    removed = list(previous.index.difference(current.index))
+    return current.loc[current.index.isin(changed_ids)], removed
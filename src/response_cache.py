@@ -0,0 +1,54 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache(object):
+    """
+    Bounded cache of API responses. Entries expire after ttl seconds, the least
+    recently used entry is evicted when full and all entries are dropped when the
+    station snapshot version changes. Each response gets an ETag computed from
+    its content. Safe to use from the event loop and worker threads at once.
+    """
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version = None
+        self.entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _check_version(self, version):
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+
+    def get(self, key, version):
+        """ Return (etag, response) cached for key and snapshot version or None """
+        with self._lock:
+            self._check_version(version)
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, etag, response = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return etag, response
+
+    def set(self, key, version, response):
+        """ Cache response computed from snapshot version, return (etag, response) """
+        etag = '"' + hashlib.sha1(
+            json.dumps(response, sort_keys=True, default=str).encode('utf-8')
+        ).hexdigest() + '"'
+        with self._lock:
+            self._check_version(version)
+            if self.maxsize <= 0:
+                return etag, response
+            self.entries[key] = time.monotonic() + self.ttl, etag, response
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return etag, response
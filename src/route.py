@@ -1,15 +1,31 @@
 import json
 import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 
 import requests
+from requests.adapters import HTTPAdapter
 
-from .settings import BING_KEY
+from .metrics import METRICS
+from .settings import (BING_KEY, BING_URL, QUERY_BUDGET, ROUTER, ROUTER_BURST,
+                       ROUTER_CONCURRENCY, ROUTER_MATRIX, ROUTER_RATE, ROUTER_RETRIES)
+from .spatial import parse_coordinates
 
 
 log = logging.getLogger("rich")
 log.setLevel(logging.ERROR)
 
-BASE_URL = 'http://dev.virtualearth.net/REST/v1/'
+BASE_URL = BING_URL
+
+MATRIX_CHUNK = 50  # Destinations, or origins, per distance matrix request
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+BACKOFF = 0.5  # Seconds, doubled on each retry before jitter
+
+MAX_BACKOFF = 30  # Seconds, also caps Retry-After
 
 
 def _get_url_params_for_route(start, end):
@@ -27,34 +43,335 @@ def _get_url_params_for_geocode(address):
     }
 
 
+def _get_url_params_for_matrix(origins, destinations):
+    return {
+        "origins": ";".join(origins),
+        "destinations": ";".join(destinations),
+        "travelMode": "driving",
+        "distanceUnit": "km",
+        "timeUnit": "minute",
+        "key": BING_KEY,
+    }
+
+
+def _chunks(items, size=MATRIX_CHUNK):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _group_for_matrix(pairs):
+    """
+    Group (start, end) pairs to (origins, destinations) requests, where either
+    side holds a single location. Pairs sharing a start are grouped first and the
+    rest by their end, so both one-to-many and many-to-one queries batch well.
+    """
+    by_start = {}
+    for start, end in pairs:
+        by_start.setdefault(start, []).append(end)
+    by_end = {}
+    for start, ends in by_start.items():
+        if len(ends) == 1:
+            by_end.setdefault(ends[0], []).append(start)
+            continue
+        for chunk in _chunks(ends):
+            yield [start], chunk
+    for end, starts in by_end.items():
+        for chunk in _chunks(starts):
+            yield chunk, [end]
+
+
+class TokenBucket(object):
+    """
+    Token bucket allowing rate requests per second on average and up to burst
+    at once. Unlimited when rate is 0.
+    """
+    def __init__(self, rate=ROUTER_RATE, burst=ROUTER_BURST):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = Lock()
+
+    def acquire(self):
+        """ Take a token, waiting until one is available """
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Budget(object):
+    """
+    Requests one query may make, unlimited when limit is 0. Once spent,
+    exhausted is set. Failed is set when a request is given up on after its
+    retries. Either leaves results of the query partial.
+    """
+    def __init__(self, limit=QUERY_BUDGET):
+        self.limit = limit
+        self.spent = 0
+        self.exhausted = False
+        self.failed = False
+        self._lock = Lock()
+
+    @property
+    def partial(self):
+        return self.exhausted or self.failed
+
+    def spend(self):
+        """ Take one request from the budget, False when none are left """
+        with self._lock:
+            if self.limit and self.spent >= self.limit:
+                self.exhausted = True
+                return False
+            self.spent += 1
+            return True
+
+
+class Scheduler(object):
+    """
+    Schedules requests to Bing Maps through one token bucket shared by all
+    routers of the process. Throttled (429) and failed (5xx) requests and
+    connection errors are retried up to retries times after exponential
+    backoff with full jitter, or after Retry-After when the response gives it.
+    Every attempt takes a token and is charged to the budget of the query.
+    """
+    def __init__(self, rate=ROUTER_RATE, burst=ROUTER_BURST, retries=ROUTER_RETRIES):
+        self.bucket = TokenBucket(rate, burst)
+        self.retries = retries
+
+    def request(self, send, budget, attempted=None):
+        """
+        Return response of send(), None when budget ran out before it was
+        made or the connection failed on every attempt. Giving up on a request
+        sets budget.failed. attempted(retry) is called after each attempt.
+        """
+        for attempt in range(self.retries + 1):
+            if not budget.spend():
+                return None
+            self.bucket.acquire()
+            try:
+                resp = send()
+            except requests.ConnectionError as error:
+                log.error(f"Connection error {error}")
+                resp = None
+            if attempted:
+                attempted(attempt > 0)
+            if resp is not None and resp.status_code not in RETRY_STATUSES:
+                return resp
+            if attempt < self.retries:
+                time.sleep(self._delay(attempt, resp))
+        budget.failed = True
+        return resp
+
+    def _delay(self, attempt, resp):
+        delay = random.uniform(0, min(BACKOFF * 2 ** attempt, MAX_BACKOFF))
+        try:
+            return max(delay, min(float(resp.headers["Retry-After"]), MAX_BACKOFF))
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return delay
+
+
+SCHEDULER = Scheduler()
+
+
+def create_router(name=ROUTER):
+    """ Router named in settings, bing or local over a road graph file """
+    if name == 'local':
+        # Imported here, the graph module is only needed for local routing
+        from .graph import LocalRouter
+        return LocalRouter()
+    if name != 'bing':
+        raise ValueError(f"Unknown router {name}, one of bing, local")
+    return Router()
+
+
 class Router(object):
-    def __init__(self):
+    """
+    Routes and geocodes with Bing Maps. Requests go through scheduler, shared
+    by default, and are charged to budget, requests for one query, renewed
+    by reset_budget when the router is shared by queries. Once the budget
+    runs out, requests return no result and exhausted is set.
+    """
+    def __init__(self, concurrency=ROUTER_CONCURRENCY, matrix=ROUTER_MATRIX,
+                 budget=QUERY_BUDGET, scheduler=None):
         super().__init__()
         self.count = 0
+        self.concurrency = max(concurrency, 1)
+        self.matrix = matrix
+        self.budget_limit = budget
+        self.budget = Budget(budget)
+        self.scheduler = scheduler if scheduler is not None else SCHEDULER
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._lock = Lock()
 
-    def get_route(self, start, end, cache):
+    def get_route(self, start, end, cache, tolerance=0):
         """
         Return distance (km) and duration (min) and collection of coordinates as
         route path from start location to end location
         """
-        route = cache.get_route_from_cache(start, end)
-        if route:
-            return route
+        return self.get_routes([(start, end)], cache, tolerance)[0]
+
+    def get_routes(self, pairs, cache, tolerance=0):
+        """
+        Return routes for list of (start, end) pairs in the same order as the pairs.
+        Cached routes are resolved first and the remaining unique pairs are fetched
+        concurrently, at most self.concurrency requests at a time. Route paths are
+        cached simplified by tolerance metres.
+        """
+        routes, misses = self._resolve_cached(pairs, cache, tolerance)
+        routes.update(self._fetch_routes(misses, cache, tolerance))
+        return [routes[pair] for pair in pairs]
+
+    def _fetch_routes(self, pairs, cache, tolerance=0):
+        """ Fetch routes for unique pairs not in cache and cache them, by pair """
+        fetched = []
+        if pairs:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                fetched = list(executor.map(self._fetch_route, *zip(*pairs)))
+
+        routes = {}
+        for (start, end), route in zip(pairs, fetched):
+            if route is None:
+                routes[(start, end)] = None, None, None
+                continue
+            cache.add_route_to_cache(start, end, *route, tolerance=tolerance)
+            routes[(start, end)] = route
+        return routes
+
+    def get_distances(self, pairs, cache):
+        """
+        Return distance (km) and duration (min) without route path for list of
+        (start, end) pairs, in the same order as the pairs. Uncached pairs are
+        fetched from the distance matrix endpoint, one request per chunk of pairs
+        sharing a start or an end. Pairs the matrix can not answer, or all pairs
+        when matrix mode is disabled, are routed one by one.
+        """
+        if not self.matrix:
+            return self.get_routes(pairs, cache)
+        routes, misses = self._resolve_cached(pairs, cache)
+        coordinates = {}
+        for location in {location for pair in misses for location in pair}:
+            coordinates[location] = self._coordinates(location, cache)
+        batches = [
+            (origins, destinations)
+            for origins, destinations in _group_for_matrix(misses)
+            if all(coordinates[location] for location in origins + destinations)
+        ]
+
+        fetched = []
+        if batches:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                fetched = list(executor.map(
+                    lambda batch: self._fetch_matrix(*batch, coordinates), batches
+                ))
 
-        resp = requests.get(f'{BASE_URL}/Routes/',
-                            params=_get_url_params_for_route(start, end))
-        self.count += 1
+        results = {}
+        for result in fetched:
+            results.update(result or {})
+        failed = []
+        for start, end in misses:
+            if (start, end) not in results:
+                failed.append((start, end))
+                continue
+            distance, duration = results[(start, end)]
+            cache.add_route_to_cache(start, end, distance, duration, None)
+            routes[(start, end)] = distance, duration, None
+        if failed:
+            # Already looked up from cache above
+            routes.update(self._fetch_routes(failed, cache))
+        return [routes[pair] for pair in pairs]
+
+    def _resolve_cached(self, pairs, cache, tolerance=None):
+        """ Resolve cached routes, including their path unless tolerance is None """
+        routes = {}
+        misses = []
+        for pair in pairs:
+            if pair in routes:
+                continue
+            route = routes[pair] = cache.get_route_from_cache(*pair, tolerance=tolerance)
+            if route is None:
+                misses.append(pair)
+        return routes, misses
+
+    @property
+    def exhausted(self):
+        """ Whether requests were left unmade because the budget ran out """
+        return self.budget.exhausted
+
+    def reset_budget(self, limit=None):
+        """ Start a new budget of limit requests, budget_limit by default """
+        self.budget = Budget(self.budget_limit if limit is None else limit)
+        return self.budget
+
+    def _count(self, endpoint, retry=False):
+        with self._lock:
+            self.count += 1
+        METRICS.increment("api_requests", endpoint)
+        if retry:
+            METRICS.increment("api_retries", endpoint)
+
+    def _get(self, endpoint, url, params):
+        """ GET through the scheduler, None when the budget has run out """
+        return self.scheduler.request(
+            lambda: self.session.get(url, params=params), self.budget,
+            lambda retry: self._count(endpoint, retry)
+        )
+
+    def _coordinates(self, location, cache):
+        if parse_coordinates(location):
+            return location
+        lat, lon = self.get_point(location, cache)
+        return f'{lat},{lon}' if lat is not None and lon is not None else None
+
+    def _fetch_matrix(self, origins, destinations, coordinates):
+        resp = self._get('DistanceMatrix', f'{BASE_URL}/Routes/DistanceMatrix',
+                         _get_url_params_for_matrix(
+                             [coordinates[origin] for origin in origins],
+                             [coordinates[destination] for destination in destinations]
+                         ))
+        if resp is None:
+            return None
+        if resp.status_code != 200:
+            log.error(f"Error {resp.status_code} when getting distance matrix")
+            return None
+        data = json.loads(resp.content)
+        results = data["resourceSets"][0]["resources"][0]["results"]
+        output = {}
+        for result in results:
+            if result.get("travelDistance", -1) < 0:
+                continue
+            origin = origins[result["originIndex"]]
+            destination = destinations[result["destinationIndex"]]
+            output[(origin, destination)] = \
+                result["travelDistance"], result["travelDuration"]
+        return output
+
+    def _fetch_route(self, start, end):
+        resp = self._get('Routes', f'{BASE_URL}/Routes/',
+                         _get_url_params_for_route(start, end))
+        if resp is None:
+            return None
         if resp.status_code != 200:
             log.error(f"Error {resp.status_code} when getting route {start} - {end}")
-            return None, None, None
+            return None
         data = json.loads(resp.content)
         route_data = data["resourceSets"][0]["resources"][0]
 
         distance = route_data["travelDistance"]
         duration = route_data["travelDuration"] / 60
         route_path = route_data["routePath"]["line"]["coordinates"]
-
-        cache.add_route_to_cache(start, end, distance, duration, route_path)
         return distance, duration, route_path
 
     def get_point(self, address, cache=None):
@@ -62,9 +379,11 @@ class Router(object):
         if point:
             return point
 
-        resp = requests.get(f'{BASE_URL}/Locations/{address}',
-                            params=_get_url_params_for_geocode(address))
-        self.count += 1
+        with METRICS.timer("geocode"):
+            resp = self._get('Locations', f'{BASE_URL}/Locations/{address}',
+                             _get_url_params_for_geocode(address))
+        if resp is None:
+            return None, None
         if resp.status_code != 200:
             print("ERR", resp.status_code, address)
             return None, None
@@ -6,4 +6,25 @@ from dotenv import load_dotenv
 load_dotenv()
 
 BING_KEY = os.getenv("BING_KEY")
+BING_URL = os.getenv("BING_URL", "http://dev.virtualearth.net/REST/v1/")
 DEV = os.getenv("DEV")
+PROVIDERS = os.getenv("PROVIDERS", "polttoaine_net")  # Comma separated
+POLTTOAINE_URL = os.getenv("POLTTOAINE_URL", "https://www.polttoaine.net")
+DATA_FOLDER = os.getenv("DATA_FOLDER")  # Defaults to data next to the script run
+ROUTER_CONCURRENCY = int(os.getenv("ROUTER_CONCURRENCY", 8))
+ROUTER_MATRIX = os.getenv("ROUTER_MATRIX", "true").lower() != "false"
+ROUTER = os.getenv("ROUTER", "bing")  # bing or local
+ROUTER_RATE = float(os.getenv("ROUTER_RATE", 10))  # Requests per second, 0 unlimited
+ROUTER_BURST = int(os.getenv("ROUTER_BURST", 20))  # Requests made at once after idling
+ROUTER_RETRIES = int(os.getenv("ROUTER_RETRIES", 3))  # On 429 and 5xx responses
+QUERY_BUDGET = int(os.getenv("QUERY_BUDGET", 0))  # Requests per query, 0 unlimited
+ROAD_GRAPH = os.getenv("ROAD_GRAPH")  # Road graph file for the local router
+SNAPSHOT_REFRESH_INTERVAL = int(os.getenv("SNAPSHOT_REFRESH_INTERVAL", 600))  # Seconds
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "sqlite")  # sqlite or json
+CACHE_GRID_SIZE = int(os.getenv("CACHE_GRID_SIZE", 100))  # Metres
+PRICE_HISTORY = os.getenv("PRICE_HISTORY", "true").lower() != "false"
+API_WORKERS = int(os.getenv("API_WORKERS", 4))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 256))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 300))  # Seconds
+STREAM_BATCH = int(os.getenv("STREAM_BATCH", 10))  # Stations routed between updates
+DETOUR_CANDIDATES = int(os.getenv("DETOUR_CANDIDATES", 3))  # Routed per ranked, 0 all
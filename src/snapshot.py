@@ -0,0 +1,108 @@
+import logging
+import threading
+import time
+from datetime import datetime
+
+import pandas as pd
+
+from .spatial import project_stations
+
+
+log = logging.getLogger("rich")
+
+RETRY_INTERVAL = 10  # Seconds between refreshes of an empty snapshot by readers
+
+
+class StationSnapshot(object):
+    """
+    Parsed and projected stations of a provider shared between queries. Refresh
+    builds a new snapshot and swaps it in as a whole, so readers never wait for a
+    refresh or see a half updated one. Without a provider, one is built by
+    create_provider on refresh, retried on each refresh until it succeeds.
+    Only one refresh runs at a time.
+    """
+    def __init__(self, provider=None, create_provider=None):
+        self.provider = provider
+        self.create_provider = create_provider
+        self._state = None, None, 0
+        self._lock = threading.Lock()
+        self._attempted = None
+
+    @property
+    def stations(self):
+        return self._state[0]
+
+    @property
+    def updated(self):
+        return self._state[1]
+
+    @property
+    def version(self):
+        return self._state[2]
+
+    @property
+    def index(self):
+        return self.provider.index if self.provider is not None else None
+
+    @property
+    def age(self):
+        """ Seconds since last successful refresh, None when never refreshed """
+        updated = self.updated
+        return (datetime.now() - updated).total_seconds() if updated else None
+
+    def get(self):
+        """
+        Return stations, refreshing first if the snapshot is still empty. None
+        while another refresh runs or one failed in the last RETRY_INTERVAL
+        seconds, so an outage does not have every reader scrape.
+        """
+        stations = self.stations
+        attempted = self._attempted
+        if stations is None and (
+            attempted is None or time.monotonic() - attempted >= RETRY_INTERVAL
+        ):
+            self.refresh()
+            stations = self.stations
+        return stations
+
+    def refresh(self):
+        """
+        Refresh stations from provider. Providers reporting changes since their
+        previous fetch only have their changed stations projected again, and the
+        version stays the same when nothing changed. Returns False if the refresh
+        failed or another one was already running.
+        """
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            self._attempted = time.monotonic()
+            return self._refresh()
+        finally:
+            self._lock.release()
+
+    def _refresh(self):
+        stations = self.stations
+        try:
+            if self.provider is None:
+                self.provider = self.create_provider()
+            if stations is None or not hasattr(self.provider, "fetch_changes"):
+                stations = project_stations(self.provider.fetch_stations())
+            else:
+                changed, removed = self.provider.fetch_changes()
+                if changed.empty and not removed:
+                    self._state = stations, datetime.now(), self.version
+                    return True
+                stations = self._apply_changes(stations, changed, removed)
+        except Exception:
+            log.exception(f"Refreshing stations from {self.provider or 'provider'} "
+                          "failed")
+            return False
+        self._state = stations, datetime.now(), self.version + 1
+        return True
+
+    def _apply_changes(self, stations, changed, removed):
+        stations = pd.concat([
+            stations.drop(index=[*removed, *changed.index], errors='ignore'),
+            project_stations(changed)
+        ])
+        return stations.reindex(self.provider.stations.index)
@@ -0,0 +1,165 @@
+import re
+
+import numpy as np
+import pyproj
+
+
+TRANSFORMER = pyproj.Transformer.from_crs('EPSG:4326', 'EPSG:32633')
+
+CELL_SIZE = 2000  # Metres
+
+EARTH_RADIUS = 6371008.8  # Metres
+
+SEGMENT_CHUNK = 256  # Route segments compared against stations at once
+
+COORDINATES = re.compile(r'^\s*(-?\d+(?:\.\d+)?)\s*,\s*(-?\d+(?:\.\d+)?)\s*$')
+
+
+def project(lat, lon):
+    """ Project WGS84 coordinates, scalars or arrays, to metric x and y """
+    return TRANSFORMER.transform(lat, lon)
+
+
+def parse_coordinates(location):
+    """ Return (lat, lon) from location given as "lat,lon" string, otherwise None """
+    match = COORDINATES.match(location) if isinstance(location, str) else None
+    return (float(match.group(1)), float(match.group(2))) if match else None
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """ Great circle distance in metres between WGS84 coordinates or arrays """
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + \
+        np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def project_stations(stations):
+    """
+    Return copy of stations with projected coordinates as float columns x and y.
+    Stations already carrying projected coordinates are returned as is.
+    """
+    if "x" in stations.columns and "y" in stations.columns:
+        return stations
+    x, y = project(stations["lat"].to_numpy(dtype=float),
+                   stations["lon"].to_numpy(dtype=float))
+    return stations.assign(x=x, y=y)
+
+
+def distance_to_line(x, y, line_x, line_y):
+    """
+    Return shortest distance from each point to polyline given as vertex arrays.
+    Segments are processed in chunks to keep the distance matrix bounded.
+    """
+    distances = np.full(len(x), np.inf)
+    if len(line_x) == 1:
+        return np.hypot(x - line_x[0], y - line_y[0])
+    px, py = x[:, None], y[:, None]
+    for start in range(0, len(line_x) - 1, SEGMENT_CHUNK):
+        end = min(start + SEGMENT_CHUNK, len(line_x) - 1)
+        ax, ay = line_x[start:end], line_y[start:end]
+        dx, dy = line_x[start + 1:end + 1] - ax, line_y[start + 1:end + 1] - ay
+        length = dx ** 2 + dy ** 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = ((px - ax) * dx + (py - ay) * dy) / length
+        t = np.clip(np.nan_to_num(t), 0, 1)
+        chunk = np.hypot(px - (ax + t * dx), py - (ay + t * dy)).min(axis=1)
+        distances = np.minimum(distances, chunk)
+    return distances
+
+
+class StationIndex(object):
+    """
+    Uniform grid over projected station coordinates. Queries only visit the
+    cells around the query geometry, so their cost does not grow with the
+    number of stations in the snapshot.
+    """
+    def __init__(self, ids, x, y, cell_size=CELL_SIZE):
+        self.ids = np.asarray(ids, dtype=object)
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.cell_size = cell_size
+        self.cells = self._build_cells()
+
+    @classmethod
+    def from_stations(cls, stations, cell_size=CELL_SIZE):
+        """ Build index from DataFrame with station ids as index and lat, lon """
+        projected = project_stations(stations)
+        return cls(projected.index.to_numpy(), projected["x"].to_numpy(),
+                   projected["y"].to_numpy(), cell_size)
+
+    @classmethod
+    def from_locations(cls, locations, cell_size=CELL_SIZE):
+        """ Build index from dict of station id to dict with lat and lon """
+        ids, lat, lon = [], [], []
+        for id, location in locations.items():
+            try:
+                lat.append(float(location.get("lat")))
+                lon.append(float(location.get("lon")))
+            except (TypeError, ValueError):
+                continue
+            ids.append(id)
+        x, y = project(np.array(lat), np.array(lon)) if ids else ([], [])
+        return cls(ids, x, y, cell_size)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _build_cells(self):
+        cells = {}
+        if not len(self.ids):
+            return cells
+        keys = zip(*self._cell(self.x, self.y))
+        for position, key in enumerate(keys):
+            cells.setdefault(key, []).append(position)
+        return {key: np.array(positions) for key, positions in cells.items()}
+
+    def _cell(self, x, y):
+        return (np.floor_divide(x, self.cell_size).astype(int),
+                np.floor_divide(y, self.cell_size).astype(int))
+
+    def _candidates(self, keys):
+        positions = [self.cells[key] for key in keys if key in self.cells]
+        return np.concatenate(positions) if positions else np.array([], dtype=int)
+
+    def within_distance(self, x, y, radius):
+        """ Return ids of stations within radius metres from projected point """
+        (min_x, max_x), (min_y, max_y) = self._cell(
+            np.array([x - radius, x + radius]), np.array([y - radius, y + radius])
+        )
+        candidates = self._candidates(
+            (cx, cy) for cx in range(min_x, max_x + 1) for cy in range(min_y, max_y + 1)
+        )
+        distances = np.hypot(self.x[candidates] - x, self.y[candidates] - y)
+        return self.ids[candidates[distances <= radius]]
+
+    def within_distance_of_line(self, line_x, line_y, radius):
+        """ Return ids of stations within radius metres from projected polyline """
+        line_x = np.asarray(line_x, dtype=float)
+        line_y = np.asarray(line_y, dtype=float)
+        samples_x, samples_y = self._sample_line(line_x, line_y)
+        reach = int(np.ceil(radius / self.cell_size)) + 1
+        keys = set()
+        for cx, cy in set(zip(*self._cell(samples_x, samples_y))):
+            keys.update(
+                (cx + dx, cy + dy)
+                for dx in range(-reach, reach + 1) for dy in range(-reach, reach + 1)
+            )
+        candidates = self._candidates(keys)
+        distances = distance_to_line(
+            self.x[candidates], self.y[candidates], line_x, line_y
+        )
+        return self.ids[candidates[distances <= radius]]
+
+    def _sample_line(self, line_x, line_y):
+        """ Points along polyline at most one cell apart, vertices included """
+        if len(line_x) < 2:
+            return line_x, line_y
+        lengths = np.hypot(np.diff(line_x), np.diff(line_y))
+        steps = np.maximum(np.ceil(lengths / self.cell_size).astype(int), 1)
+        segment = np.repeat(np.arange(len(lengths)), steps)
+        offsets = np.arange(steps.sum()) - np.repeat(np.cumsum(steps) - steps, steps)
+        t = offsets / steps[segment]
+        samples_x = line_x[segment] + t * np.diff(line_x)[segment]
+        samples_y = line_y[segment] + t * np.diff(line_y)[segment]
+        return np.append(samples_x, line_x[-1]), np.append(samples_y, line_y[-1])